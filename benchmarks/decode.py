@@ -0,0 +1,62 @@
+## Compares the JSON decoders available to Stack.PY.
+#
+# The benchmark decodes a synthetic response that resembles a page of
+# /questions (100 items with nested owners, tags and text) and reports the
+# time each decoder takes. Run it from the root of the repository:
+#
+#     python benchmarks/decode.py [iterations]
+#
+# Decoding the bytes directly is compared with decoding into a str first, which
+# is what earlier versions of Stack.PY did.
+
+import os
+import sys
+from json import dumps, loads
+from timeit import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from stackpy.decoder import default_decoder, json_decoder
+
+## Generates a response resembling a page of questions.
+# @param count the number of items in the response
+# @return the response as UTF-8 encoded bytes
+def sample_response(count=100):
+    items = []
+    for i in range(count):
+        items.append({'tags':               ['python', 'json', 'performance'],
+                      'owner':              {'reputation':    1000 + i,
+                                             'user_id':       50000 + i,
+                                             'user_type':     'registered',
+                                             'profile_image': 'https://www.gravatar.com/avatar/%032x' % i,
+                                             'display_name':  'User éè %d' % i,
+                                             'link':          'https://stackoverflow.com/users/%d' % (50000 + i),},
+                      'is_answered':        bool(i % 2),
+                      'view_count':         i * 37,
+                      'answer_count':       i % 5,
+                      'score':              i % 13 - 3,
+                      'last_activity_date': 1350000000 + i,
+                      'creation_date':      1340000000 + i,
+                      'question_id':        10000000 + i,
+                      'link':               'https://stackoverflow.com/questions/%d' % (10000000 + i),
+                      'title':              'How do I decode JSON quickly? (%d)' % i,
+                      'body':               '<p>' + 'Lorem ipsum dolor sit amet. ' * 40 + '</p>',})
+    return dumps({'items': items, 'has_more': True, 'quota_max': 10000, 'quota_remaining': 9999,}).encode('UTF-8')
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    data = sample_response()
+    candidates = [('json (str)',   lambda: loads(data.decode('UTF-8'))),
+                  ('json (bytes)', lambda: json_decoder(data)),]
+    if default_decoder() is not json_decoder:
+        decoder = default_decoder()
+        candidates.append(('%s (bytes)' % decoder.__module__, lambda: decoder(data)))
+    print('Decoding %d bytes %d times:' % (len(data), iterations))
+    baseline = None
+    for (name, function) in candidates:
+        elapsed = timeit(function, number=iterations)
+        baseline = baseline or elapsed
+        print('  %-16s %8.2f ms per response  (%.2fx)' % (name, elapsed / iterations * 1000, baseline / elapsed))
+
+if __name__ == '__main__':
+    main()
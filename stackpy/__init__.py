@@ -18,6 +18,9 @@
 #   documentation directly corresponds with the current code.
 
 from .api import API
-from .site import Site
+from .site import Site, SiteRegistry
+from .sync import Mirror
 from .filter import Filter
+from .metrics import Metrics
+from .profiler import FieldProfiler
 from .url import APIError
\ No newline at end of file
@@ -1,11 +1,10 @@
+from json import loads
 from urllib.parse import urlencode
-from urllib.request import urlopen
-from urllib.error import HTTPError
 from urllib.parse import parse_qs
-from zlib import decompress, error, MAX_WBITS
 
 from .request import Request
 from .site import Site
+from .transport import ConnectionPool
 from .url import APIError, URL
 
 ## @cond META
@@ -77,21 +76,21 @@ class API(metaclass=MetaAPI):
     # Note that this method requires that API.client_id and API.client_secret be set.
     @staticmethod
     def complete_explicit(code, redirect_uri):
-        # Catch any HTTP errors because we want to grab error messages
+        ConnectionPool.prepare()
+        (status, raw_data) = ConnectionPool.current.request('https://stackexchange.com/oauth/access_token',
+                                                            urlencode({'client_id':     API.client_id,
+                                                                       'client_secret': API.client_secret,
+                                                                       'code':          code,
+                                                                       'redirect_uri':  redirect_uri,}).encode('UTF-8'),
+                                                            decode=True)
+        if status == 200:
+            return parse_qs(raw_data.decode('UTF-8'))['access_token'][0]
+        # Any other status indicates an error whose details are in the body
         try:
-            raw_data = urlopen('https://stackexchange.com/oauth/access_token',
-                               data=urlencode({'client_id':     API.client_id,
-                                               'client_secret': API.client_secret,
-                                               'code':          code,
-                                               'redirect_uri':  redirect_uri,})).read()
-            return parse_qs(raw_data)['access_token'][0]
-        except HTTPError as e:
-            try:
-                json_data = decompress(e.read(), 16 + MAX_WBITS).decode('UTF-8')
-                data = loads(json_data)
-                raise APIError(data['error']['type'], data['error']['message'] if 'message' in data['error'] else 'unknown error')
-            except error:
-                raise APIError(0, 'unable to decompress GZipped response from API server')
+            data = loads(raw_data.decode('UTF-8'))
+        except ValueError:
+            raise APIError(0, 'unable to decode response from API server')
+        raise APIError(data['error']['type'], data['error']['message'] if 'message' in data['error'] else 'unknown error')
     
     ## Begins the implicit authentication flow.
     # @param scope the type of access the application is requesting (separate more than one item with a comma)
@@ -0,0 +1,70 @@
+# NumPy is optional and only required by to_arrays
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .types import TYPE_INFORMATION
+
+## Determines whether a field contains a timestamp.
+# @param item_type the type of the items containing the field
+# @param path a list of names leading to the field through nested types
+# @return True if the field is listed in the date_fields of its type
+def is_date_field(item_type, path):
+    for name in path[:-1]:
+        type_map = TYPE_INFORMATION.get(item_type, {}).get('type_map', {})
+        if not name in type_map:
+            return False
+        item_type = type_map[name]
+    return path[-1] in TYPE_INFORMATION.get(item_type, {}).get('date_fields', [])
+
+## Extracts the specified fields from raw items into columns.
+# @param pages an iterable of lists of raw items (dictionaries)
+# @param fields a list of field names - nested fields are separated with a period (for example 'owner.user_id')
+# @return a dictionary mapping each field name to a list of values, with None for missing values
+def extract_columns(pages, fields):
+    paths = [(f, f.split('.'),) for f in fields]
+    columns = {f: [] for f in fields}
+    for items in pages:
+        for item in items:
+            for (field, path) in paths:
+                value = item
+                for name in path:
+                    value = value.get(name) if isinstance(value, dict) else None
+                columns[field].append(value)
+    return columns
+
+## Converts columns into NumPy masked arrays.
+# @param columns a dictionary of columns as returned by extract_columns
+# @param item_type the type of the items the columns were extracted from
+# @return a dictionary mapping each field name to a numpy.ma.MaskedArray
+#
+# Timestamps are converted to datetime64[s] and missing values are masked.
+# Integer, boolean and floating point columns receive the corresponding NumPy
+# type while any other column uses the object type.
+def to_arrays(columns, item_type):
+    if numpy is None:
+        raise ImportError('NumPy is required for converting columns to arrays.')
+    arrays = {}
+    for (field, values) in columns.items():
+        mask = [v is None for v in values]
+        present = [v for v in values if not v is None]
+        if is_date_field(item_type, field.split('.')):
+            (dtype, fill) = ('datetime64[s]', 0)
+        elif present and all(isinstance(v, bool) for v in present):
+            (dtype, fill) = (numpy.bool_, False)
+        elif present and all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+            (dtype, fill) = (numpy.int64, 0)
+        elif present and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+            (dtype, fill) = (numpy.float64, 0.0)
+        else:
+            (dtype, fill) = (object, None)
+        if dtype is object:
+            # numpy.array would turn lists of equal length into a second dimension
+            data = numpy.empty(len(values), dtype=object)
+            for (index, value) in enumerate(values):
+                data[index] = value
+        else:
+            data = numpy.array([fill if m else v for (v, m) in zip(values, mask)], dtype=dtype)
+        arrays[field] = numpy.ma.masked_array(data, mask=mask)
+    return arrays
@@ -1,15 +1,86 @@
+from atexit import register
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from gzip import compress
+from hashlib import blake2b, sha256
+from multiprocessing.util import Finalize
+from os import getpid
 from sqlite3 import connect
-from time import time
+from threading import Lock, RLock, Thread, local
+from time import sleep, time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from zlib import decompress, MAX_WBITS
+
+from .decoder import default_decoder
 
 CACHE_TABLE_SCHEMA = '''
   CREATE TABLE cache (
-    url varchar(255) NOT NULL,
+    key blob NOT NULL,
+    data blob NOT NULL,
+    expires int(11) NOT NULL,
+    PRIMARY KEY (key)
+  );
+'''
+
+## The version of the schema above, stored in the database's user_version.
+#
+# - version 0 stored the decoded JSON as text
+# - version 1 stores the GZipped response as a blob
+# - version 2 replaces the URL with its cache key (see cache_key)
+CACHE_SCHEMA_VERSION = 2
+
+CACHE_INDEX_SCHEMA = '''
+  CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+'''
+
+ENTITY_TABLE_SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS entities (
+    site varchar(255) NOT NULL,
+    type varchar(255) NOT NULL,
+    filter varchar(255) NOT NULL,
+    id varchar(255) NOT NULL,
     data text NOT NULL,
     expires int(11) NOT NULL,
-    PRIMARY KEY (url)
+    PRIMARY KEY (site, type, filter, id)
   );
 '''
 
+ENTITY_INDEX_SCHEMA = '''
+  CREATE INDEX IF NOT EXISTS entities_expires ON entities (expires);
+'''
+
+FILTER_TABLE_SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS filters (
+    key text NOT NULL,
+    filter varchar(255) NOT NULL,
+    PRIMARY KEY (key)
+  );
+'''
+
+## Computes the cache key for a request.
+# @param path the methods of the request joined with slashes
+# @param parameters a dictionary or a list of tuples containing the query string parameters
+# @return a 16-byte digest
+#
+# The key is independent of the order of the parameters and of the API key.
+# Since responses to authenticated requests differ between users, the access
+# token does contribute to the key, but only a digest of it is hashed so that
+# it cannot be recovered from the key.
+def cache_key(path, parameters):
+    parameters = dict(parameters)
+    parameters.pop('key', None)
+    if 'access_token' in parameters:
+        parameters['access_token'] = sha256(parameters['access_token'].encode('UTF-8')).hexdigest()
+    canonical = '%s?%s' % (path, urlencode(sorted(parameters.items())),)
+    return blake2b(canonical.encode('UTF-8'), digest_size=16).digest()
+
+## Computes the cache key for a complete URL.
+# @param url the URL as returned by URL.__str__
+# @return a 16-byte digest
+def url_cache_key(url):
+    parts = urlsplit(url)
+    return cache_key(parts.path.split('/', 2)[2], parse_qsl(parts.query, keep_blank_values=True))
+
 ## Provides a means of managing connections to a database.
 #
 # This class is used for a number of purposes, the most important of which is
@@ -19,65 +90,405 @@ class Database:
     ## The current database that is being used.
     current = None
     
+    ## The in-memory cache of decoded responses that is consulted before the current database.
+    memory = None
+    
+    ## The function used to decode cached and received JSON.
+    #
+    # The function receives the document as UTF-8 encoded bytes (or as a str
+    # for individual entities) and returns the decoded value. By default,
+    # orjson or ujson is used if installed and the json module otherwise.
+    decoder = default_decoder()
+    
     ## Determines if a database is initialized and initializes one otherwise.
     #
     # If you attempt to fetch data before specifying a database class, an
     # in-memory SQLite database will be used by default. This database only
-    # exists while the current process is running.
+    # exists while the current process is running. A MemoryCache with the
+    # default limits is likewise created if none was specified, and the memory
+    # cache is emptied if a different database has become the current one.
     @staticmethod
     def prepare():
         if Database.current is None:
             Database.current = SQLiteDatabase(':memory:')
+        if Database.memory is None:
+            Database.memory = MemoryCache()
+        Database.memory.scope(Database.current)
+
+## Provides a bounded in-process cache of decoded responses.
+#
+# Retrieving a response from the database requires a query and decoding the
+# stored JSON. A MemoryCache keeps the most recently used decoded responses so
+# that repeated requests avoid both. Entries expire at the same time as the
+# corresponding database entries, and the least recently used entries are
+# evicted once either the number of entries or their approximate size exceeds
+# the limits. The entries belong to a single database (see MemoryCache.scope)
+# and the cache may be shared between threads.
+class MemoryCache:
+    
+    ## Constructs the cache.
+    # @param max_entries the maximum number of responses to keep (0 disables the cache)
+    # @param max_bytes the maximum combined size of the responses' JSON
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._max_bytes   = max_bytes
+        self._entries     = OrderedDict() # cache key -> (data, size, expires)
+        self._bytes       = 0
+        self._hits        = 0
+        self._misses      = 0
+        self._evictions   = 0
+        self._database    = None # the database the entries were stored in
+        self._lock        = Lock()
+    
+    ## Adds the specified data to the cache.
+    # @param key the cache key of the request
+    # @param data the decoded data
+    # @param size the approximate size of the data in bytes
+    # @param expires the time at which the entry expires
+    def add_to_cache(self, key, data, size, expires):
+        if size > self._max_bytes or not self._max_entries:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (data, size, expires,)
+            self._bytes += size
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+    
+    ## Purges all entries from the cache.
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    ## Associates the cache with a database.
+    # @param database the database the entries that are added belong to
+    #
+    # The entries are purged if they belong to a different database, so that
+    # responses cached for one database are never returned for another.
+    def scope(self, database):
+        if not self._database is database:
+            with self._lock:
+                self._entries.clear()
+                self._bytes = 0
+                self._database = database
+    
+    ## Retrieves the data for the specified key from the cache.
+    # @param key the cache key of the request
+    # @param with_expiry whether to also return the time at which the entry expires
+    # @param grace the number of seconds after expiry during which an entry is still returned
+    # @return the corresponding JSON as UTF-8 encoded bytes (or a tuple containing the JSON and expiry time) or None if unavailable
+    def retrieve_from_cache(self, key, with_expiry=False, grace=0):
+        with self._lock:
+            if key in self._entries:
+                (data, size, expires) = self._entries[key]
+                if expires + grace >= time():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return (data, expires,) if with_expiry else data
+                self._remove(key)
+            self._misses += 1
+            return None
+    
+    ## Returns statistics about the use of the cache.
+    # @return a dictionary with the number of hits, misses, evictions, entries and bytes
+    def stats(self):
+        with self._lock:
+            return {'hits':      self._hits,
+                    'misses':    self._misses,
+                    'evictions': self._evictions,
+                    'entries':   len(self._entries),
+                    'bytes':     self._bytes,}
+    
+    ## Removes an entry if it exists.
+    # @param key the cache key of the entry
+    def _remove(self, key):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
 
 ## Provides an interface to an SQLite database.
+#
+# The database may be shared by many threads and processes. Each thread uses
+# its own connection (except for in-memory databases, which only exist within
+# a single connection that is shared under a lock), and database files are
+# switched to write-ahead logging so that readers do not block writers.
+#
+# Writes to the cache are batched: entries (and the objects added to the entity
+# cache along with them) are kept in memory (where they are immediately visible
+# to readers in the same process) and written in a single transaction once
+# enough have accumulated. A background thread writes any
+# remaining entries every batch_interval seconds, so that other processes see
+# them shortly after they were added. Pending entries are also written when the
+# process exits or SQLiteDatabase.flush is called. A batch_interval of 0
+# disables batching.
+#
+# A database may also be used by processes forked from the one that created it
+# (for example by multiprocessing workers). The child discards the connections
+# and pending entries it inherited, opens its own connection and starts its own
+# background thread. Since multiprocessing children do not run atexit handlers,
+# the pending entries of a child are also written when it exits normally.
 class SQLiteDatabase:
     
     ## Creates / initializes the specified SQLite database.
     # @param database the filename of the database to use
     # @param clear whether to clear expired entries from the cache at startup or not
+    # @param batch_size the number of pending entries that triggers a write
+    # @param batch_interval the maximum number of seconds pending entries are kept before being written (0 to write them immediately)
+    # @param timeout the number of seconds to wait for another process to release a lock
+    # @param grace the number of seconds expired entries are retained for (see URL.set_grace)
     #
     # Note: you may use ':memory:' for the database parameter to specify an
     # in-memory database.
-    def __init__(self, database, clear=True):
-        self._connection = connect(database)
-        if not self._table_exists('cache'):
-            self._connection.execute(CACHE_TABLE_SCHEMA)
-        elif clear:
+    def __init__(self, database, clear=True, batch_size=32, batch_interval=1, timeout=30, grace=0):
+        self._database       = database
+        self._grace          = grace
+        self._batch_size     = batch_size
+        self._batch_interval = batch_interval
+        self._timeout        = timeout
+        self._local          = local()
+        self._pending        = {} # cache key -> (data, expires)
+        self._entities       = {} # (site, type, filter, id) -> (data, expires)
+        self._flusher        = None # the thread writing pending entries periodically
+        self._lock           = RLock() # protects the pending entries
+        self._pid            = getpid() # the process the connections and the thread belong to
+        if database == ':memory:':
+            self._shared = connect(database, isolation_level=None, check_same_thread=False)
+            self._connection_lock = RLock()
+        else:
+            self._shared = None
+            self._connection_lock = nullcontext()
+        with self._transaction() as c:
+            if not self._table_exists('cache'):
+                c.execute(CACHE_TABLE_SCHEMA)
+                c.execute('PRAGMA user_version = %d' % CACHE_SCHEMA_VERSION)
+            else:
+                self._migrate(c)
+            c.execute(CACHE_INDEX_SCHEMA)
+            c.execute(ENTITY_TABLE_SCHEMA)
+            c.execute(ENTITY_INDEX_SCHEMA)
+            c.execute(FILTER_TABLE_SCHEMA)
+        if clear:
             self.clear()
+        register(self.flush)
+    
+    ## Returns the connection for the current thread.
+    # @return the connection
+    #
+    # Note: callers must hold _connection_lock while using the connection.
+    def _connection(self):
+        if not self._shared is None:
+            return self._shared
+        self._check_process()
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = connect(self._database, timeout=self._timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+        return connection
+    
+    ## Runs the enclosed statements in a write transaction.
+    # @return a context manager that yields the connection
+    #
+    # The transaction acquires the write lock immediately so that concurrent
+    # writers in other processes wait (up to the timeout) instead of failing.
+    @contextmanager
+    def _transaction(self):
+        with self._connection_lock:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+    
+    ## Runs a query and returns the first row.
+    # @param query the SQL query
+    # @param parameters the parameters for the query
+    # @return the first row or None
+    def _query(self, query, parameters=()):
+        with self._connection_lock:
+            return self._connection().execute(query, parameters).fetchone()
     
     ## Determines whether the specified table exists within the database.
     # @param name the name of the table to check
     # @return True if the table exists
     def _table_exists(self, name):
-        c = self._connection.execute('SELECT name FROM sqlite_master WHERE type="table" AND name=?', [name,])
-        return not c.fetchone() is None
+        return not self._query('SELECT name FROM sqlite_master WHERE type="table" AND name=?', [name,]) is None
+    
+    ## Upgrades the cache table created by an earlier version of Stack.PY.
+    # @param c the connection (within a transaction)
+    def _migrate(self, c):
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            # Compress the JSON stored in each row
+            rows = c.execute('SELECT url, data, expires FROM cache').fetchall()
+            c.executemany('UPDATE cache SET data = ? WHERE url = ?',
+                          [(compress(str(data).encode('UTF-8')), url,) for (url, data, expires) in rows])
+        if version < 2:
+            # Rebuild the table, replacing each URL with its cache key
+            rows = c.execute('SELECT url, data, expires FROM cache').fetchall()
+            c.execute('DROP TABLE cache')
+            c.execute(CACHE_TABLE_SCHEMA)
+            c.executemany('INSERT OR REPLACE INTO cache (key, data, expires) VALUES (?,?,?)',
+                          [(url_cache_key(url), data, expires,) for (url, data, expires) in rows])
+        c.execute('PRAGMA user_version = %d' % CACHE_SCHEMA_VERSION)
     
-    ## Adds the specified URL and data to the cache.
-    # @param url the URL of the request
-    # @param data the data that corresponds with the URL
+    ## Adds the specified data to the cache.
+    # @param key the cache key of the request
+    # @param data the GZipped response (bytes) or the decoded JSON (str) that corresponds with the URL
     # @param ttl the Time-To-Live (TTL) for this entry
-    def add_to_cache(self, url, data, ttl):
-        # Remove any existing entries and enter the new one
-        self._connection.execute('DELETE FROM cache WHERE url = ?', (url,))
-        self._connection.execute('INSERT INTO cache (url, data, expires) VALUES (?,?,?)',
-                                 [str(url), str(data), int(time()) + ttl,])
+    #
+    # The data is stored compressed - a str is compressed before being stored.
+    def add_to_cache(self, key, data, ttl):
+        if isinstance(data, str):
+            data = compress(data.encode('UTF-8'))
+        self._check_process()
+        with self._lock:
+            self._pending[key] = (data, int(time()) + ttl,)
+            full = self._schedule()
+        if full:
+            self.flush()
+    
+    ## Resets the state inherited from the parent if this is a forked process.
+    #
+    # SQLite connections must not be used across a fork, the thread writing
+    # pending entries does not exist in the child and the parent remains
+    # responsible for the pending entries it holds. The locks are replaced
+    # since they may have been held by another thread of the parent.
+    def _check_process(self):
+        if self._pid == getpid():
+            return
+        self._pid      = getpid()
+        self._local    = local()
+        self._pending  = {}
+        self._entities = {}
+        self._flusher  = None
+        self._lock     = RLock()
+        Finalize(self, self.flush, exitpriority=0)
+    
+    ## Determines whether the pending entries must be written now.
+    # @return True if the batch is full or batching is disabled
+    #
+    # The thread writing pending entries periodically is started otherwise.
+    # This method must be called while holding the lock.
+    def _schedule(self):
+        if len(self._pending) >= self._batch_size or self._batch_interval <= 0:
+            return True
+        if self._flusher is None:
+            self._flusher = Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+        return False
+    
+    ## Writes any pending entries to the database.
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            entities, self._entities = self._entities, {}
+        if pending or entities:
+            with self._transaction() as c:
+                c.executemany('INSERT OR REPLACE INTO cache (key, data, expires) VALUES (?,?,?)',
+                              [(key, data, expires,) for (key, (data, expires)) in pending.items()])
+                c.executemany('INSERT OR REPLACE INTO entities (site, type, filter, id, data, expires) VALUES (?,?,?,?,?,?)',
+                              [key + (data, expires,) for (key, (data, expires)) in entities.items()])
+    
+    ## Writes pending entries every batch_interval seconds.
+    #
+    # This method runs on a daemon thread that is started by the first entry
+    # that is not written immediately.
+    def _flush_periodically(self):
+        while True:
+            sleep(self._batch_interval)
+            self.flush()
     
     ## Purges entries from the cache.
-    # @param clear_all whether to purge all entries from the cache instead of only expired ones
+    # @param clear_all whether to purge all entries from the cache (and Database.memory) instead of only expired ones
+    #
+    # Note: expired entries within the grace period are retained.
     def clear(self, clear_all=False):
-        if clear_all:
-            self._connection.execute('DELETE FROM cache')
-        else:
-            self._connection.execute('DELETE FROM cache WHERE expires < ?', [int(time()),])
-    
-    ## Retrieves the data for the specified URL from the cache.
-    # @param url the URL of the request
-    # @return the corresponding data or None if unavailable
-    def retrieve_from_cache(self, url):
-        c = self._connection.execute('SELECT data FROM cache WHERE url = ? AND expires >= ?',
-                                     [str(url), int(time()),])
-        row = c.fetchone()
-        # If the row was found, return the first item
-        if not row is None:
-            row = row[0]
-        return row
\ No newline at end of file
+        with self._lock:
+            if clear_all:
+                self._pending.clear()
+                self._entities.clear()
+            with self._transaction() as c:
+                if clear_all:
+                    c.execute('DELETE FROM cache')
+                    c.execute('DELETE FROM entities')
+                else:
+                    c.execute('DELETE FROM cache WHERE expires < ?', [int(time()) - self._grace,])
+                    c.execute('DELETE FROM entities WHERE expires < ?', [int(time()),])
+        if clear_all and not Database.memory is None:
+            # The memory cache would otherwise keep returning the purged responses
+            Database.memory.clear()
+    
+    ## Retrieves the data for the specified key from the cache.
+    # @param key the cache key of the request
+    # @param with_expiry whether to also return the time at which the entry expires
+    # @param grace the number of seconds after expiry during which an entry is still returned
+    # @return the corresponding JSON as UTF-8 encoded bytes (or a tuple containing the JSON and expiry time) or None if unavailable
+    def retrieve_from_cache(self, key, with_expiry=False, grace=0):
+        with self._lock:
+            row = self._pending.get(key)
+        if row is None:
+            row = self._query('SELECT data, expires FROM cache WHERE key = ?', [key,])
+        if row is None or row[1] + grace < int(time()):
+            return None
+        # The data is only decompressed once it has been found
+        data = decompress(row[0], 16 + MAX_WBITS)
+        return (data, row[1],) if with_expiry else data
+    
+    ## Adds individual objects to the entity cache.
+    # @param scope a tuple containing the site, type and filter of the objects
+    # @param entities a list of tuples containing the ID and JSON of each object
+    # @param ttl the Time-To-Live (TTL) for the objects
+    #
+    # The objects are written along with the pending cache entries (and do not
+    # count towards batch_size).
+    def add_entities(self, scope, entities, ttl):
+        expires = int(time()) + ttl
+        self._check_process()
+        with self._lock:
+            self._entities.update((scope + (id,), (data, expires,)) for (id, data) in entities)
+            full = self._schedule()
+        if full:
+            self.flush()
+    
+    ## Retrieves individual objects from the entity cache.
+    # @param scope a tuple containing the site, type and filter of the objects
+    # @param ids a list of IDs
+    # @return a dictionary mapping the ID of each object found to its JSON
+    def retrieve_entities(self, scope, ids):
+        now = int(time())
+        # Pending objects take precedence over those already written
+        with self._lock:
+            pending = {id: self._entities.get(scope + (id,)) for id in ids}
+        entities = {id: row[0] for (id, row) in pending.items() if not row is None and row[1] >= now}
+        ids = [id for id in ids if pending[id] is None]
+        # Stay well below SQLite's limit on the number of parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            with self._connection_lock:
+                c = self._connection().execute('SELECT id, data FROM entities WHERE site = ? AND type = ? AND filter = ? AND id IN (%s) AND expires >= ?' % ','.join('?' * len(chunk)),
+                                               list(scope) + chunk + [now,])
+                entities.update(c.fetchall())
+        return entities
+    
+    ## Records the ID of a filter created with the API.
+    # @param key the canonical description of the filter (see Filter.key)
+    # @param filter_id the ID returned by the API
+    #
+    # Filters never expire, so the entry is written immediately and is not
+    # affected by SQLiteDatabase.clear.
+    def add_filter(self, key, filter_id):
+        with self._transaction() as c:
+            c.execute('INSERT OR REPLACE INTO filters (key, filter) VALUES (?,?)', [key, filter_id,])
+    
+    ## Retrieves the ID of a filter created with the API.
+    # @param key the canonical description of the filter (see Filter.key)
+    # @return the filter ID or None if the filter has not been created
+    def retrieve_filter(self, key):
+        row = self._query('SELECT filter FROM filters WHERE key = ?', [key,])
+        return None if row is None else row[0]
\ No newline at end of file
@@ -0,0 +1,24 @@
+from json import loads
+
+# orjson and ujson are optional and used in that order of preference
+try:
+    from orjson import loads as _fast_loads
+except ImportError:
+    try:
+        from ujson import loads as _fast_loads
+    except ImportError:
+        _fast_loads = None
+
+## Decodes a JSON document using the standard library.
+# @param data the document as UTF-8 encoded bytes or as a str
+# @return the decoded value
+#
+# json.loads accepts bytes directly, so the document is never converted into
+# an intermediate str by the caller.
+def json_decoder(data):
+    return loads(data)
+
+## Returns the fastest JSON decoder that is installed.
+# @return a function accepting UTF-8 encoded bytes or a str and returning the decoded value
+def default_decoder():
+    return json_decoder if _fast_loads is None else _fast_loads
@@ -1,4 +1,4 @@
-
+from .database import Database
 
 ## Represents a filter for controlling the data returned in a response.
 #
@@ -14,6 +14,9 @@ class Filter:
     # are instantiated after setting this attribute.
     default = 'default'
     
+    # The IDs of the filters created in this process indexed by Filter.key
+    _registry = {}
+    
     ## Constructs a filter object.
     # @param base the ID of an existing filter
     def __init__(self, base=None):
@@ -55,13 +58,36 @@ class Filter:
         self._dirty = True
         return self
     
+    ## Returns the canonical description of the filter.
+    # @return a string that is identical for all filters with the same base, includes and excludes
+    #
+    # The order of the includes and excludes does not affect the description.
+    def key(self):
+        return '%s|%s|%s' % (self._filter_id,
+                             ';'.join(sorted(set(self._includes))),
+                             ';'.join(sorted(set(self._excludes))),)
+    
     ## Creates the filter.
+    #
+    # Filters never change once created, so the ID of each filter is recorded in
+    # the current database and in the current process. The API is only contacted
+    # for filters that are not found in either.
     def create(self):
-        import url
-        f_url = url.URL()
-        f_url.add_method('filters').add_method('create').add_parameter('base', self._filter_id)
-        f_url.set_post_data({'include': ';'.join(self._includes),
-                             'exclude': ';'.join(self._excludes),})
-        self._filter_id = f_url.fetch(True)['items'][0]['filter']
+        from .url import URL
+        key = self.key()
+        filter_id = Filter._registry.get(key)
+        if filter_id is None:
+            Database.prepare()
+            filter_id = Database.current.retrieve_filter(key)
+            if filter_id is None:
+                url = URL().add_method('filters').add_method('create').add_parameter('base', self._filter_id)
+                url = url.add_parameter('include', ';'.join(sorted(set(self._includes))))
+                url = url.add_parameter('exclude', ';'.join(sorted(set(self._excludes))))
+                filter_id = url.switch_to_post().fetch(True)['items'][0]['filter']
+                Database.current.add_filter(key, filter_id)
+            Filter._registry[key] = filter_id
+        self._filter_id = filter_id
+        self._includes  = []
+        self._excludes  = []
         self._dirty = False
         return self
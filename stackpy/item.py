@@ -1,21 +1,86 @@
+from collections.abc import Sequence
 from datetime import datetime
 from string import capwords
 
+from .profiler import FieldProfiler
 from .types import TYPE_INFORMATION
 
 ## A common wrapper for all returned items.
 #
 # This class serves a very important purpose - it makes use of the meta type
 # information to provide intelligent access to data members.
+#
+# Constructing an Item actually returns an instance of a subclass specific to
+# the item's type. These subclasses are generated once per type (see
+# Item.for_type) and hold the type information in a form that is quick to
+# query, while each instance only stores the wrapped dictionary and the values
+# converted so far.
 class Item:
     
+    __slots__ = ('_data', '_cache',)
+    
+    # The type information below is replaced in each generated subclass
+    _item_type   = ''
+    _type_info   = {}
+    _type_name   = ''
+    _id_field    = None
+    _str_field   = None
+    _date_fields = frozenset()
+    _type_map    = {}
+    
+    # The base method of the request returning the items (only set while profiling)
+    _route = None
+    
+    # The generated subclasses indexed by type (or by type and route)
+    _classes = {}
+    
+    ## Returns the class used for items of the specified type.
+    # @param item_type the type of data
+    # @param route the base method of the request returning the items if field usage is to be recorded
+    # @return a subclass of Item
+    #
+    # The classes for a route record every field that is read from their items
+    # (and from items nested within them) with the current FieldProfiler.
+    @staticmethod
+    def for_type(item_type, route=None):
+        if not route is None:
+            if not (item_type, route,) in Item._classes:
+                base = Item.for_type(item_type)
+                item_class = type(base.__name__, (base,), {
+                    '__slots__':   (),
+                    '_route':      route,
+                    '__getattr__': _profiled_getattr,
+                })
+                Item._classes.setdefault((item_type, route,), item_class)
+            return Item._classes[(item_type, route,)]
+        if not item_type in Item._classes:
+            type_info = TYPE_INFORMATION[item_type] if item_type in TYPE_INFORMATION else {}
+            type_name = capwords(item_type, '_').replace('_', ' ')
+            item_class = type(type_name.replace(' ', '') + 'Item', (Item,), {
+                '__slots__':    (),
+                '_item_type':   item_type,
+                '_type_info':   type_info,
+                '_type_name':   type_name,
+                '_id_field':    type_info.get('id_field'),
+                '_str_field':   type_info.get('str_field'),
+                '_date_fields': frozenset(type_info.get('date_fields', [])),
+                '_type_map':    type_info.get('type_map', {}),
+            })
+            Item._classes.setdefault(item_type, item_class)
+        return Item._classes[item_type]
+    
+    ## Creates an instance of the class for the specified type.
+    # @param data a dictionary
+    # @param item_type the type of data
+    def __new__(cls, data=None, item_type=''):
+        return object.__new__(Item.for_type(item_type) if cls is Item else cls)
+    
     ## Constructs an Item to wrap the supplied dictionary.
     # @param data a dictionary
     # @param item_type the type of data
-    def __init__(self, data, item_type):
-        self._data      = data
-        self._type_info = TYPE_INFORMATION[item_type] if item_type in TYPE_INFORMATION else {}
-        self._type_name = capwords(item_type, '_').replace('_', ' ')
+    def __init__(self, data, item_type=''):
+        self._data  = data
+        self._cache = None
     
     ## Indicates whether the specified attribute exists in the disctionary.
     # @param index the index to retrieve
@@ -26,18 +91,42 @@ class Item:
     ## Returns the specified attribute from the dictionary.
     # @param index the index to retrieve
     # @return the item at the specified index
+    #
+    # Timestamps and nested items are converted on first access and the
+    # converted values are reused for subsequent accesses.
     def __getattr__(self, index):
+        # Members of the data never begin with an underscore - this also avoids
+        # recursion when the slots have not been initialized
+        if index.startswith('_'):
+            raise AttributeError(index)
+        cache = self._cache
+        if not cache is None and index in cache:
+            return cache[index]
         # Catch any KeyErrors and rethrow them as AttributeErrors
         try:
-            # First determine if the requested member is a timestamp
-            if index in self._type_field('date_fields', []):
-                return datetime.fromtimestamp(self._data[index])
-            # Either return the requested item or it if is another type, return a new Item instance
-            if index in self._type_field('type_map', {}):
-                return Item(self._data[index], self._type_info['type_map'][index])
-            return self._data[index]
+            value = self._data[index]
         except KeyError as e:
             raise AttributeError(e)
+        # Determine if the requested member is a timestamp or another type
+        if index in self._date_fields:
+            value = datetime.fromtimestamp(value)
+        elif index in self._type_map:
+            item_class = Item.for_type(self._type_map[index], self._route)
+            if isinstance(value, list):
+                value = [item_class(v) for v in value]
+            else:
+                value = item_class(value)
+        else:
+            return value
+        if cache is None:
+            cache = self._cache = {}
+        cache[index] = value
+        return value
+    
+    ## Returns the information needed to pickle the item.
+    # @return a tuple containing the class and its arguments
+    def __reduce__(self):
+        return (Item, (self._data, self._item_type,),)
     
     ## Returns an internal representation of the response.
     # @return the internal representation
@@ -50,7 +139,7 @@ class Item:
     ## Returns a string representation of the response.
     # @return the string representation
     def __str__(self):
-        str_field = self._type_field('str_field') if self._type_field('str_field') in self._data else self._type_field('id_field')
+        str_field = self._str_field if self._str_field in self._data else self._id_field
         if not str_field in self._data:
             raise KeyError('Unable to construct a string representation of the item.')
         return str(self._data[str_field])
@@ -64,5 +153,60 @@ class Item:
     ## Returns the ID of the item.
     # @return the ID of the item or None if unavailable
     def id(self):
-        id_field = self._type_field('id_field')
-        return self._data[id_field] if id_field in self._data else None
+        return self._data[self._id_field] if self._id_field in self._data else None
+
+## Records the field with the current FieldProfiler before returning it.
+# @param self the item
+# @param index the index to retrieve
+# @return the item at the specified index
+def _profiled_getattr(self, index):
+    profiler = FieldProfiler.current
+    if not profiler is None and not index.startswith('_'):
+        profiler.record(self._route, self._item_type, index)
+    return Item.__getattr__(self, index)
+
+## A list of items that are only wrapped once they are accessed.
+#
+# Responses frequently contain many items of which only a few (or none) are
+# used. An ItemList wraps each item when it is first indexed or reached during
+# iteration and reuses the wrapped item afterwards. Slicing returns another
+# ItemList without wrapping anything. The unwrapped dictionaries are available
+# as ItemList.raw for consumers that do not need wrapped items at all.
+class ItemList(Sequence):
+    
+    ## Constructs the list.
+    # @param raw a list of dictionaries
+    # @param factory a function that wraps a dictionary
+    # @param items a list of items that were already wrapped (or None for those that were not)
+    def __init__(self, raw, factory, items=None):
+        ## The unwrapped dictionaries.
+        self.raw      = raw
+        self._factory = factory
+        self._items   = [None] * len(raw) if items is None else items
+    
+    ## Returns the item or items at the specified index.
+    # @param index an integer or a slice
+    # @return the wrapped item or an ItemList containing the items in the slice
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ItemList(self.raw[index], self._factory, self._items[index])
+        item = self._items[index]
+        if item is None:
+            item = self._items[index] = self._factory(self.raw[index])
+        return item
+    
+    ## Provides a means of iterating through the items.
+    # @return an iterator for the items
+    def __iter__(self):
+        for index in range(len(self.raw)):
+            yield self[index]
+    
+    ## Returns the number of items.
+    # @return the number of items
+    def __len__(self):
+        return len(self.raw)
+    
+    ## Returns an internal representation of the list.
+    # @return the internal representation
+    def __repr__(self):
+        return repr(list(self))
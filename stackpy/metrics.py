@@ -0,0 +1,124 @@
+from bisect import bisect_left
+from threading import Lock
+
+## The upper bounds of the histogram buckets for durations (in seconds).
+TIME_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10,]
+
+## The upper bounds of the histogram buckets for sizes (in bytes).
+SIZE_BUCKETS = [1024 * 4 ** i for i in range(8)]
+
+## The metrics that are recorded and the buckets used for each.
+#
+# - `cache_lookup` - the time taken to look up a response in the cache
+# - `cache_hit` / `cache_miss` - recorded with a value of 1 for each lookup
+# - `http` - the time taken to send a request and receive the response
+# - `bytes` - the size of the compressed response
+# - `decompress` - the time taken to decompress a response
+# - `parse` - the time taken to decode the JSON of a response
+# - `wrap` - the time taken to wrap an item in its response object
+# - `quota` - the quota consumed, recorded with a value of 1 for each response from the API
+METRICS = {'cache_lookup': TIME_BUCKETS,
+           'cache_hit':    [1,],
+           'cache_miss':   [1,],
+           'http':         TIME_BUCKETS,
+           'bytes':        SIZE_BUCKETS,
+           'decompress':   TIME_BUCKETS,
+           'parse':        TIME_BUCKETS,
+           'wrap':         TIME_BUCKETS,
+           'quota':        [1,],}
+
+## Summarizes the values recorded for a metric.
+class Histogram:
+    
+    ## Constructs an empty histogram.
+    # @param bounds a sorted list of the upper bounds of the buckets
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1) # the last bucket has no upper bound
+        self.count = 0
+        self.sum   = 0
+        self.min   = None
+        self.max   = None
+    
+    ## Adds a value to the histogram.
+    # @param value the value
+    def add(self, value):
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.sum   += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+    
+    ## Returns the contents of the histogram.
+    # @return a dictionary containing the count, sum, minimum, maximum and the count for each bucket
+    #
+    # The buckets are a list of tuples containing the upper bound of the bucket
+    # (None for the last bucket) and the number of values in it.
+    def snapshot(self):
+        return {'count':   self.count,
+                'sum':     self.sum,
+                'min':     self.min,
+                'max':     self.max,
+                'buckets': list(zip(self._bounds + [None,], self._counts)),}
+
+## Collects measurements of the work done for each request.
+#
+# Instrumentation is disabled by default and has no cost in that case. Once a
+# Metrics object is the current one, each measurement listed in METRICS is
+# recorded for the base method of the request (see URL.base_method) and
+# summarized in a Histogram. The histograms can be retrieved with
+# Metrics.snapshot, and hooks can be registered to forward each individual
+# measurement to an external monitoring system.
+class Metrics:
+    
+    ## The current collector or None if instrumentation is disabled (the default).
+    current = None
+    
+    ## Constructs a collector.
+    def __init__(self):
+        self._histograms = {} # (base method, metric) -> Histogram
+        self._hooks      = []
+        self._lock       = Lock()
+    
+    ## Registers a function that receives every measurement.
+    # @param hook a function accepting the base method, the name of the metric and the value
+    #
+    # Hooks are called on the thread that made the measurement and must
+    # therefore return quickly.
+    def add_hook(self, hook):
+        with self._lock:
+            self._hooks = self._hooks + [hook,]
+    
+    ## Removes a function registered with Metrics.add_hook.
+    # @param hook the function to remove
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h != hook]
+    
+    ## Records a measurement.
+    # @param base_method the base method of the request
+    # @param name the name of the metric (see METRICS)
+    # @param value the measured value
+    def record(self, base_method, name, value):
+        with self._lock:
+            key = (base_method, name,)
+            if not key in self._histograms:
+                self._histograms[key] = Histogram(METRICS.get(name, TIME_BUCKETS))
+            self._histograms[key].add(value)
+            hooks = self._hooks
+        for hook in hooks:
+            hook(base_method, name, value)
+    
+    ## Returns the measurements recorded so far.
+    # @return a dictionary mapping each base method to a dictionary mapping each metric to a Histogram snapshot
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for ((base_method, name), histogram) in self._histograms.items():
+                snapshot.setdefault(base_method, {})[name] = histogram.snapshot()
+            return snapshot
+    
+    ## Discards the measurements recorded so far.
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
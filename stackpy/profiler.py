@@ -0,0 +1,119 @@
+from threading import Lock
+
+from .filter import Filter
+from .types import TYPE_INFORMATION
+
+## The members of the response wrapper that Stack.PY relies upon.
+WRAPPER_FIELDS = ['.backoff',
+                  '.error_id',
+                  '.error_message',
+                  '.error_name',
+                  '.has_more',
+                  '.items',
+                  '.page',
+                  '.page_size',
+                  '.quota_max',
+                  '.quota_remaining',
+                  '.total',
+                  '.type',]
+
+## Records which fields of the returned items are used and builds filters from them.
+#
+# Responses frequently contain many fields that are never read. While a
+# profiler is the current profiler, every attribute that is read from an Item
+# is recorded along with the base method of the request that returned it (see
+# URL.base_method). FieldProfiler.filter then synthesizes the smallest filter
+# that contains these fields for each base method.
+#
+# Once the application has been run with representative data (the warm-up),
+# FieldProfiler.freeze fixes the synthesized filters, and requests that do not
+# specify a filter use the frozen filter for their base method from then on.
+# Filters are never applied without being frozen, since a field that is only
+# read from some items (for example only for questions with a high score)
+# would otherwise be missing from the next page. Fields are still recorded
+# while the filters are applied, so freezing again includes any field that was
+# missing from a filter.
+#
+# Note: only attributes read from Item objects are recorded - fields that are
+# read from the raw dictionaries (for example by Request.to_columns) are not.
+class FieldProfiler:
+    
+    ## The current profiler or None if profiling is disabled (the default).
+    current = None
+    
+    ## Constructs a profiler.
+    def __init__(self):
+        self._fields = {} # base method -> set of 'type.field'
+        self._frozen = {} # base method -> Filter
+        self._lock   = Lock()
+    
+    ## Records that a field was read.
+    # @param base_method the base method of the request that returned the item
+    # @param item_type the type of the item
+    # @param field the name of the field
+    def record(self, base_method, item_type, field):
+        entry = '%s.%s' % (item_type, field,)
+        fields = self._fields.get(base_method)
+        if fields is None or not entry in fields:
+            with self._lock:
+                self._fields.setdefault(base_method, set()).add(entry)
+    
+    ## Returns the fields that were recorded.
+    # @param base_method the base method to return the fields for or None for all base methods
+    # @return a sorted list of the fields in the form 'type.field'
+    def fields(self, base_method=None):
+        with self._lock:
+            if base_method is None:
+                return sorted(set().union(*self._fields.values()))
+            return sorted(self._fields.get(base_method, ()))
+    
+    ## Synthesizes the filter for a base method.
+    # @param base_method the base method of a request
+    # @return a Filter or None if no fields were recorded for the base method
+    #
+    # The filter is based on the 'none' filter and includes the recorded fields,
+    # the members of the response wrapper and the ID and string fields of each
+    # type the recorded fields belong to.
+    def filter(self, base_method):
+        fields = self.fields(base_method)
+        if not fields:
+            return None
+        includes = set(fields) | set(WRAPPER_FIELDS)
+        for item_type in set(f.split('.', 1)[0] for f in fields):
+            type_info = TYPE_INFORMATION.get(item_type, {})
+            for name in ('id_field', 'str_field',):
+                if name in type_info:
+                    includes.add('%s.%s' % (item_type, type_info[name],))
+        return Filter('none').add_includes(sorted(includes))
+    
+    ## Fixes the synthesized filters so that requests use them.
+    # @param base_methods a list of the base methods to freeze the filters for or None for every base method with recorded fields
+    #
+    # Calling this method again replaces the frozen filters with ones that
+    # include the fields recorded in the meantime.
+    def freeze(self, base_methods=None):
+        if base_methods is None:
+            with self._lock:
+                base_methods = list(self._fields)
+        for base_method in base_methods:
+            synthesized = self.filter(base_method)
+            if not synthesized is None:
+                with self._lock:
+                    self._frozen[base_method] = synthesized
+    
+    ## Returns the frozen filter for a base method.
+    # @param base_method the base method of a request
+    # @return a Filter or None if no filter was frozen for the base method
+    def frozen_filter(self, base_method):
+        return self._frozen.get(base_method)
+    
+    ## Stops requests from using the frozen filters.
+    def unfreeze(self):
+        with self._lock:
+            self._frozen.clear()
+    
+    ## Discards all recorded fields and frozen filters.
+    def reset(self):
+        with self._lock:
+            self._fields.clear()
+            self._frozen.clear()
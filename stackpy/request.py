@@ -1,10 +1,144 @@
-from copy import deepcopy
+from asyncio import Semaphore, gather, get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge
+from queue import Full, Queue
+from threading import Event, Thread
+from time import perf_counter
 from urllib.parse import quote
 
-from .item import Item
-from .types import METHOD_TO_TYPE_MAPPING
+from .columns import extract_columns, to_arrays
+from .filter import Filter
+from .item import Item, ItemList
+from .metrics import Metrics
+from .profiler import FieldProfiler
+from .types import ENTITY_METHODS, METHOD_TO_TYPE_MAPPING, TYPE_INFORMATION
 from .url import URL
 
+## Iterates over a generator while it is advanced on a worker thread.
+# @param source the generator to advance
+# @param depth the maximum number of values to retrieve ahead of the consumer
+# @return a generator yielding the values from source
+#
+# Any exception raised by source is re-raised in the consumer. Closing the
+# returned generator stops the worker once its current value is ready.
+def _read_ahead(source, depth):
+    return _interleave([source,], depth)
+
+## Iterates over several generators at once, each advanced on its own worker thread.
+# @param sources a list of the generators to advance
+# @param depth the maximum number of values to retrieve ahead of the consumer
+# @return a generator yielding the values from every source in the order they become available
+#
+# Any exception raised by a source is re-raised in the consumer. Closing the
+# returned generator stops the workers once their current values are ready.
+def _interleave(sources, depth):
+    (queue, stopped) = _start_workers(sources, depth)
+    yield from _drain(queue, stopped, len(sources))
+
+## Starts advancing several generators, each on its own worker thread.
+# @param sources a list of the generators to advance
+# @param depth the maximum number of values to retrieve ahead of the consumer
+# @return a tuple containing the queue receiving the values and the Event that stops the workers
+#
+# The workers start immediately rather than when the values are first
+# requested. Setting the Event stops them once their current values are ready.
+def _start_workers(sources, depth):
+    queue = Queue(depth)
+    stopped = Event()
+    # Waits for room in the queue, giving up if the consumer has stopped
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+    def worker(source):
+        try:
+            for value in source:
+                if not put((True, value)):
+                    return
+        except Exception as e:
+            put((False, e))
+        else:
+            put((False, None))
+        finally:
+            source.close()
+    for source in sources:
+        Thread(target=worker, args=(source,), daemon=True).start()
+    return (queue, stopped,)
+
+## Yields the values received from the workers started by _start_workers.
+# @param queue the queue receiving the values
+# @param stopped the Event that stops the workers, which is set when the generator is closed
+# @param count the number of workers
+# @return a generator yielding the values until every worker has finished
+def _drain(queue, stopped, count):
+    try:
+        remaining = count
+        while remaining:
+            (is_value, value) = queue.get()
+            if not is_value:
+                if value is not None:
+                    raise value
+                remaining -= 1
+                continue
+            yield value
+    finally:
+        stopped.set()
+
+## Merges the responses for the parts of a request into a single response.
+# @param responses a list of the data for each part
+# @return the merged data
+#
+# The items are concatenated in the order of the parts (see _ordered for
+# restoring the order of the IDs). The response indicates that more items are
+# available if any part does, and reports the lowest remaining quota.
+def _merge(responses):
+    data = dict(responses[0])
+    data['items'] = [i for r in responses for i in r['items']]
+    data['has_more'] = any(r.get('has_more') for r in responses)
+    if 'quota_remaining' in data:
+        data['quota_remaining'] = min(r['quota_remaining'] for r in responses)
+    if any('backoff' in r for r in responses):
+        data['backoff'] = max(r.get('backoff', 0) for r in responses)
+    return data
+
+## Combines objects from the entity cache with the response for the remaining IDs.
+# @param url the URL of the original request
+# @param ids the list of IDs that were requested
+# @param cached a dictionary of the cached objects indexed by ID
+# @param data the response for the IDs that were not cached
+# @return the combined data with the objects in the order of the IDs
+#
+# If the filter excludes the ID field, the fetched objects cannot be ordered and
+# follow the cached ones in the order they were returned.
+def _combine(url, ids, cached, data):
+    id_field = TYPE_INFORMATION[METHOD_TO_TYPE_MAPPING[url.base_method()]]['id_field']
+    data = dict(data)
+    if not all(id_field in i for i in data['items']):
+        data['items'] = [cached[i] for i in ids if i in cached] + data['items']
+        return data
+    fetched = {str(i[id_field]): i for i in data['items']}
+    data['items'] = [cached[i] if i in cached else fetched[i] for i in ids if i in cached or i in fetched]
+    return data
+
+## Orders the items of a response for specific objects by the requested IDs.
+# @param url the URL of the request
+# @param data the response
+# @return the data with the objects in the order of the IDs
+#
+# The API returns objects requested by ID (see types.ENTITY_METHODS) in its
+# default sort order rather than in the order of the IDs, and a request split
+# into several parts is sorted within each part only. The order of the IDs is
+# therefore restored unless the request specifies its own sort order.
+def _ordered(url, data):
+    ids = url.vector()
+    if ids is None or not url.base_method() in ENTITY_METHODS or not url.parameter('sort') is None:
+        return data
+    return _combine(url, ids, {}, data)
+
 ## Represents a request for API data.
 #
 # The Request object provides a standard interface for creating requests for API
@@ -70,6 +204,12 @@ class Request:
                      'delete',
                      'edit',]
     
+    ## The maximum number of IDs the API accepts in a single request.
+    max_ids = 100
+    
+    ## The maximum number of simultaneous requests made when a request contains more than max_ids IDs.
+    max_parallel = 4
+    
     ## Creates a request object.
     # @param url the domain name to initialize the URL to or a URL instance
     # @param method a method name to append to the URL
@@ -77,7 +217,7 @@ class Request:
     def __init__(self, url=None, method=None, response_type=Item):
         self._url = URL(url) if isinstance(url, str) else url
         if not method is None:
-            self._url.add_method(method)
+            self._url = self._url.add_method(method)
         self._response_type = response_type
         self._data = None
     
@@ -96,8 +236,8 @@ class Request:
             iter(items)
         except (KeyError, TypeError):
             items = [items,]
-        # Now we have a list of 'things' - convert them to a list of strings and join them
-        self._url.add_method(';'.join(quote(item_str(i), '/') for i in items), True)
+        # Now we have a list of 'things' - convert them to a list of strings and add them
+        self._url = self._url.add_vector([quote(item_str(i), '/') for i in items])
         return self
     
     ## Appends the specified item to the appropriate part of the URL.
@@ -107,38 +247,45 @@ class Request:
     def __getattr__(self, raw_item):
         # access_token is a singular exception to this rule
         item = raw_item if raw_item == 'access_token' else raw_item.replace('_', '-')
-        # No matter what, we're going to be modifying the URL, so make
-        # a deep copy of it
-        url = deepcopy(self._url)
+        # URLs are immutable, so the new request can share this request's URL
+        url = self._url
         if item in self._methods:
             if item in self._post_methods:
-                url.switch_to_post()
+                url = url.switch_to_post()
             return Request(url, item)
         else:
             # This is a neat trick - we return a local function that will
             # finish setting the parameter in the URL once the user provides
             # the value for the specified parameter.
             def set_parameter(value):
-                url.add_parameter(item, value)
-                return Request(url)
+                return Request(url.add_parameter(item, value))
             return set_parameter
     
     ## Retrieves the item or data at the specified index and returns it.
     # @param index the index to retrieve the item / data from
     # @return the item / data at the specified index
     #
-    # This method serves a dual purpose - if supplied with an integer value it
-    # will return the item at such an index. If however, supplied with a string,
-    # it will return the appropriate value from the response. For example, given
-    # the value 'total', it will return the total number of items in the set.
+    # This method serves a dual purpose - if supplied with an integer value (or a
+    # slice) it will return the item at such an index. If however, supplied with
+    # a string, it will return the appropriate value from the response. For
+    # example, given the value 'total', it will return the total number of items
+    # in the set.
+    #
+    # Note: request['items'] is an ItemList and the unwrapped dictionaries are
+    # available as request['items'].raw.
     def __getitem__(self, index):
-        return self._fetch()['items'][index] if type(index) == int else self._fetch()[index]
+        return self._fetch()['items'][index] if isinstance(index, (int, slice)) else self._fetch()[index]
     
     ## Provides a means of iterating through the response.
     # @return an iterator for the response
     def __iter__(self):
         return iter(self._fetch()['items'])
     
+    ## Provides a means of asynchronously iterating through the response.
+    # @return an asynchronous iterator for the response
+    def __aiter__(self):
+        return self._aiter()
+    
     ## Returns the total number of items in the response.
     # @return the number of items in the response
     def __len__(self):
@@ -149,15 +296,298 @@ class Request:
     def __repr__(self):
         return "<Request '%s'>" % self._url
     
+    ## Iterates over each page of the response.
+    # @param pagesize the number of items to request per page (the URL's own value is used if set)
+    # @param prefetch the number of pages to retrieve ahead of the consumer on a worker thread
+    # @return a generator yielding the data for each page
+    #
+    # Pages are requested one at a time as the generator advances, starting with
+    # the page specified for the request (or the first page), and continuing
+    # until the API indicates that there are no more items. Pages are not
+    # retained by the request, so memory use remains constant.
+    #
+    # If prefetch is nonzero, up to that many pages are fetched in the background
+    # while the current page is being processed. Any backoff value returned by
+    # the API is observed by the Scheduler before the next page is requested.
+    def iter_pages(self, pagesize=100, prefetch=0):
+        pages = self._pages(pagesize)
+        if prefetch:
+            pages = _read_ahead(pages, prefetch)
+        try:
+            for data in pages:
+                yield self._wrap(data)
+        finally:
+            pages.close()
+    
+    ## Iterates over every item in the response, following pagination.
+    # @param pagesize the number of items to request per page
+    # @param prefetch the number of pages to retrieve ahead of the consumer on a worker thread
+    # @param incremental whether to decode each page while it is being received
+    # @return a generator yielding each item
+    #
+    # In incremental mode, the items of a page are yielded as soon as they have
+    # been received rather than once the complete page has been decoded (see
+    # URL.stream). Incremental mode cannot be combined with prefetching.
+    def stream(self, pagesize=100, prefetch=0, incremental=False):
+        if incremental and prefetch:
+            raise ValueError('incremental mode cannot be combined with prefetching')
+        if not incremental:
+            for data in self.iter_pages(pagesize, prefetch):
+                yield from data['items']
+            return
+        # The pages are only complete once their items have been consumed, which
+        # happens before _pages checks for further pages
+        for data in self._pages(pagesize, self._stream_page):
+            factory = self._factory(self._item_type(data))
+            for item in data['items']:
+                yield factory(item)
+    
+    ## Runs the request on several sites at once and merges the results.
+    # @param sites a list of Site objects or API site parameters
+    # @param sort the name of the field to order the merged items by or None to yield them as they arrive
+    # @param pages the number of pages to retrieve from each site or None to retrieve every page
+    # @param pagesize the number of items to request per page
+    # @return a generator yielding a tuple containing the Site and the item
+    #
+    # The request serves as a template - its site is replaced with each of the
+    # sites in turn. The sites are queried concurrently, each on its own worker
+    # thread, while the Scheduler limits the combined rate of requests.
+    #
+    # If sort is specified, the items from each site must already be ordered by
+    # that field (for example by sorting questions by 'creation' and merging
+    # them by 'creation_date'). The sites are then merged into a single ordered
+    # stream, in descending order unless the request's order is 'asc'.
+    def fanout(self, sites, sort=None, pages=1, pagesize=100):
+        from .site import Site
+        sites = [Site(s) if isinstance(s, str) else s for s in sites]
+        def items(site):
+            request = Request(self._url.add_parameter('site', site._domain), None, self._response_type)
+            for (number, data) in enumerate(request.iter_pages(pagesize), 1):
+                for item in data['items']:
+                    yield (site, item,)
+                if number == pages:
+                    break
+        if sort is None:
+            yield from _interleave([items(s) for s in sites], pagesize)
+            return
+        # merge primes its inputs one after another, so every site must be
+        # started beforehand for the first pages to be retrieved concurrently
+        workers = [_start_workers([items(s),], pagesize) for s in sites]
+        try:
+            yield from merge(*[_drain(queue, stopped, 1) for (queue, stopped) in workers],
+                             key=lambda pair: getattr(pair[1], sort),
+                             reverse=self._url.parameter('order', 'desc') != 'asc')
+        finally:
+            for (queue, stopped) in workers:
+                stopped.set()
+    
+    ## Extracts the specified fields from the items in the response into columns.
+    # @param fields a list of field names - nested fields are separated with a period (for example 'owner.user_id')
+    # @param paginate whether to include the items from every page instead of only the current one
+    # @param pagesize the number of items to request per page when paginating
+    # @return a dictionary mapping each field name to a list of values, with None for missing values
+    #
+    # The values are read directly from the response without creating an Item
+    # for each row, so timestamps are returned as integers.
+    def to_columns(self, fields, paginate=False, pagesize=100):
+        return extract_columns((items for (items, item_type) in self._raw_pages(paginate, pagesize)), fields)
+    
+    ## Extracts the specified fields from the items in the response into NumPy arrays.
+    # @param fields a list of field names - nested fields are separated with a period (for example 'owner.user_id')
+    # @param paginate whether to include the items from every page instead of only the current one
+    # @param pagesize the number of items to request per page when paginating
+    # @return a dictionary mapping each field name to a numpy.ma.MaskedArray
+    #
+    # Timestamps are converted to datetime64[s] and missing values are masked.
+    # Note: this method requires NumPy.
+    def to_numpy(self, fields, paginate=False, pagesize=100):
+        item_types = []
+        def pages():
+            for (items, item_type) in self._raw_pages(paginate, pagesize):
+                item_types.append(item_type)
+                yield items
+        columns = extract_columns(pages(), fields)
+        return to_arrays(columns, item_types[0] if item_types else self._item_type({}))
+    
+    ## Retrieves the unwrapped items of the response.
+    # @param paginate whether to retrieve every page instead of only the current one
+    # @param pagesize the number of items to request per page when paginating
+    # @return a generator yielding a tuple containing the raw items and their type for each page
+    def _raw_pages(self, paginate, pagesize):
+        if not paginate:
+            data = self._fetch()
+            yield (data['items'].raw, self._item_type(data),)
+            return
+        for data in self._pages(pagesize):
+            yield (data['items'], self._item_type(data),)
+    
+    ## Retrieves the raw data for each page of the response.
+    # @param pagesize the number of items to request per page
+    # @param retrieve the function retrieving the data for a URL (Request._retrieve by default)
+    # @return a generator yielding the data for each page
+    def _pages(self, pagesize, retrieve=None):
+        page = int(self._url.parameter('page', 1))
+        pagesize = self._url.parameter('pagesize', pagesize)
+        while True:
+            url = self._url.add_parameter('page', page).add_parameter('pagesize', pagesize)
+            data = (retrieve or self._retrieve)(url)
+            yield data
+            if not data.get('has_more'):
+                break
+            page += 1
+    
+    ## Prepares the incremental retrieval of a page.
+    # @param url the URL of the page
+    # @return a dictionary whose 'items' member is a generator yielding each raw item
+    #
+    # The remaining members are filled in as the generator is consumed.
+    def _stream_page(self, url):
+        url = self._profiled(url)
+        data = {}
+        def items():
+            for part in url.split(self.max_ids):
+                envelope = {}
+                yield from part.stream(envelope)
+                has_more = data.get('has_more', False) or envelope.get('has_more', False)
+                data.update(envelope)
+                data['has_more'] = has_more
+        data['items'] = items()
+        return data
+    
+    ## Fetches the data for the request without blocking.
+    # @return the request
+    #
+    # This coroutine must be awaited before the request is indexed or iterated
+    # synchronously inside an event loop, otherwise the data is fetched with a
+    # blocking call.
+    async def aload(self):
+        if self._data is None:
+            self._data = self._wrap(await self._aretrieve(self._url))
+        return self
+    
+    ## Asynchronously yields each item in the response.
+    # @return an asynchronous generator yielding each item
+    async def _aiter(self):
+        await self.aload()
+        for item in self._data['items']:
+            yield item
+    
     ## Either fetches the data for the request or returns the data.
     # @return the data for the request
     def _fetch(self):
         if self._data is None:
-            # Fetch the data and replace the 'items' entry with initialized response objects
-            self._data = self._url.fetch()
-            if self._url.base_method() in METHOD_TO_TYPE_MAPPING:
-                item_type = METHOD_TO_TYPE_MAPPING[self._url.base_method()]
-            else:
-                item_type = self._data['type'] if 'type' in self._data else ''
-            self._data['items'] = [self._response_type(i, item_type) for i in self._data['items']]
-        return self._data
\ No newline at end of file
+            self._data = self._wrap(self._retrieve(self._url))
+        return self._data
+    
+    ## Retrieves the data for a URL.
+    # @param url the URL to retrieve
+    # @return the data for the URL
+    #
+    # Objects already present in the entity cache are not requested again (see
+    # URL.retrieve_entities), and objects requested by ID are returned in the
+    # order of the IDs (see _ordered).
+    def _retrieve(self, url):
+        url = self._profiled(url)
+        entities = url.retrieve_entities()
+        if entities and entities[1]:
+            (ids, cached) = entities
+            missing = [i for i in ids if not i in cached]
+            data = self._retrieve_split(url.replace_vector(missing)) if missing else {'items': [], 'has_more': False,}
+            return _combine(url, ids, cached, data)
+        return _ordered(url, self._retrieve_split(url))
+    
+    ## Retrieves the data for a URL, splitting it into several requests if it contains too many IDs.
+    # @param url the URL to retrieve
+    # @return the data for the URL
+    #
+    # The requests are made concurrently on up to max_parallel threads and their
+    # responses are merged in the order of the parts (Request._retrieve then
+    # restores the order of the IDs). Each part is cached on its own, so a
+    # repeated part is served from the cache.
+    def _retrieve_split(self, url):
+        urls = url.split(self.max_ids)
+        if len(urls) == 1:
+            return url.fetch()
+        with ThreadPoolExecutor(min(self.max_parallel, len(urls))) as executor:
+            return _merge(list(executor.map(URL.fetch, urls)))
+    
+    ## Retrieves the data for a URL without blocking.
+    # @param url the URL to retrieve
+    # @return the data for the URL
+    async def _aretrieve(self, url):
+        url = self._profiled(url)
+        # The entity cache is queried without blocking the event loop
+        entities = await get_running_loop().run_in_executor(None, url.retrieve_entities)
+        if entities and entities[1]:
+            (ids, cached) = entities
+            missing = [i for i in ids if not i in cached]
+            data = (await self._aretrieve_split(url.replace_vector(missing))) if missing else {'items': [], 'has_more': False,}
+            return _combine(url, ids, cached, data)
+        return _ordered(url, await self._aretrieve_split(url))
+    
+    ## Retrieves the data for a URL without blocking, splitting it if it contains too many IDs.
+    # @param url the URL to retrieve
+    # @return the data for the URL
+    async def _aretrieve_split(self, url):
+        urls = url.split(self.max_ids)
+        if len(urls) == 1:
+            return await url.afetch()
+        semaphore = Semaphore(self.max_parallel)
+        async def afetch(url):
+            async with semaphore:
+                return await url.afetch()
+        return _merge(await gather(*(afetch(u) for u in urls)))
+    
+    ## Replaces the 'items' entry in the data with a list of response objects.
+    # @param data the data returned for the request
+    # @return the data
+    #
+    # The objects are only initialized as they are accessed (see ItemList).
+    def _wrap(self, data):
+        data['items'] = ItemList(data['items'], self._factory(self._item_type(data)))
+        return data
+    
+    ## Returns the function that wraps each item in the response.
+    # @param item_type the type of the items
+    # @return a function that accepts a dictionary and returns the response object
+    #
+    # While a FieldProfiler is active, the items record the fields that are read
+    # from them. The time taken to wrap each item is recorded with the current
+    # Metrics.
+    def _factory(self, item_type):
+        if self._response_type is Item and not FieldProfiler.current is None:
+            factory = Item.for_type(item_type, self._url.base_method())
+        else:
+            response_type = self._response_type
+            factory = lambda i: response_type(i, item_type)
+        metrics = Metrics.current
+        if metrics is None:
+            return factory
+        base_method = self._url.base_method()
+        def measured(i):
+            start = perf_counter()
+            item = factory(i)
+            metrics.record(base_method, 'wrap', perf_counter() - start)
+            return item
+        return measured
+    
+    ## Applies the filter frozen by the current FieldProfiler to a URL.
+    # @param url the URL to retrieve
+    # @return the URL using the frozen filter or the original URL
+    #
+    # The filter is only applied if one was frozen for the URL's base method (see
+    # FieldProfiler.freeze) and the URL does not specify its own filter.
+    def _profiled(self, url):
+        profiler = FieldProfiler.current
+        if profiler is None or url.parameter('filter') != Filter.default:
+            return url
+        frozen = profiler.frozen_filter(url.base_method())
+        return url if frozen is None else url.add_parameter('filter', frozen)
+    
+    ## Determines the type of the items in the response.
+    # @param data the data returned for the request
+    # @return the type of the items
+    def _item_type(self, data):
+        if self._url.base_method() in METHOD_TO_TYPE_MAPPING:
+            return METHOD_TO_TYPE_MAPPING[self._url.base_method()]
+        return data['type'] if 'type' in data else ''
\ No newline at end of file
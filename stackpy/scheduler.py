@@ -0,0 +1,99 @@
+from threading import Lock
+from time import sleep, time
+
+## Controls the rate at which requests are sent to the API.
+#
+# Every request passes through the current scheduler before it is sent. The
+# scheduler enforces three limits:
+#
+# - a token bucket that limits the number of requests per second
+# - the backoff value the API returns for a method, during which no further
+#   requests for that method may be made
+# - the remaining quota, which gradually reduces the rate once it falls below
+#   a fraction of the total so that the quota is not exhausted in a burst
+#
+# The scheduler may be shared between threads and event loops.
+class Scheduler:
+    
+    ## The current scheduler that is being used.
+    current = None
+    
+    ## Determines if a scheduler is initialized and initializes one otherwise.
+    @staticmethod
+    def prepare():
+        if Scheduler.current is None:
+            Scheduler.current = Scheduler()
+    
+    ## Constructs a scheduler.
+    # @param rate the maximum number of requests per second
+    # @param burst the number of requests that may be made at once before the rate applies
+    # @param low_quota the fraction of the quota below which the rate is reduced
+    # @param min_rate the rate that is never undercut when the quota is low
+    def __init__(self, rate=25, burst=None, low_quota=0.1, min_rate=0.5):
+        self._rate      = rate
+        self._burst     = rate if burst is None else burst
+        self._low_quota = low_quota
+        self._min_rate  = min_rate
+        self._tokens    = self._burst
+        self._updated   = time()
+        self._backoff   = {} # base method -> time at which the backoff expires
+        self._quota_remaining = None
+        self._quota_max       = None
+        self._lock = Lock()
+    
+    ## Reserves the right to make a request.
+    # @param base_method the base method of the request
+    # @return the number of seconds the caller must wait before making the request
+    #
+    # This method does not block - use Scheduler.wait to block until the request
+    # may be made. Coroutines should instead sleep for the returned interval.
+    def reserve(self, base_method):
+        with self._lock:
+            now = time()
+            rate = self._current_rate()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = -self._tokens / rate if self._tokens < 0 else 0
+            if base_method in self._backoff:
+                delay = max(delay, self._backoff[base_method] - now)
+            return delay
+    
+    ## Blocks until a request may be made.
+    # @param base_method the base method of the request
+    def wait(self, base_method):
+        delay = self.reserve(base_method)
+        if delay > 0:
+            sleep(delay)
+    
+    ## Records the rate limiting information included in a response.
+    # @param base_method the base method of the request
+    # @param data the decoded response
+    def update(self, base_method, data):
+        with self._lock:
+            if 'backoff' in data:
+                self._backoff[base_method] = time() + data['backoff']
+            if 'quota_remaining' in data:
+                self._quota_remaining = data['quota_remaining']
+            if 'quota_max' in data:
+                self._quota_max = data['quota_max']
+    
+    ## Returns the current state of the scheduler.
+    # @return a dictionary describing the rate, tokens, quota and active backoffs
+    def state(self):
+        with self._lock:
+            now = time()
+            return {'rate':            self._current_rate(),
+                    'tokens':          min(self._burst, self._tokens + (now - self._updated) * self._current_rate()),
+                    'quota_remaining': self._quota_remaining,
+                    'quota_max':       self._quota_max,
+                    'backoff':         {m: t - now for (m, t) in self._backoff.items() if t > now},}
+    
+    ## Returns the rate after accounting for the remaining quota.
+    # @return the number of requests per second
+    def _current_rate(self):
+        if not self._quota_remaining is None and self._quota_max:
+            fraction = self._quota_remaining / (self._quota_max * self._low_quota)
+            if fraction < 1:
+                return max(self._min_rate, self._rate * fraction)
+        return self._rate
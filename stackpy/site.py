@@ -1,4 +1,8 @@
+from threading import Lock
+
+from .item import Item
 from .request import Request
+from .url import URL
 
 ## Represents an entry point into any Stack Exchange site.
 #
@@ -11,6 +15,9 @@ from .request import Request
 # sites, you may want to simply use API.sites to enumerate the sites and display
 # the list to the user. This avoids the need to create a Site object since the
 # return value of API.sites is a list of pre-initialized Site objects.
+#
+# The information about each site is provided by the current SiteRegistry, so
+# that a site can also be specified by its name or URL.
 class Site:
     
     # A list of all top-level site-specific methods
@@ -30,15 +37,24 @@ class Site:
                 'users',]
     
     ## Constructs a Site object for the specified site.
-    # @param data the domain name of the site or data returned from the /sites method
+    # @param data the domain name, API site parameter, name or URL of the site or data returned from the /sites method
     # @param ignored this parameter is ignored
+    #
+    # Strings in lowercase without spaces or slashes are taken to be API site
+    # parameters or domain names, which the API accepts as they are, and never
+    # cause the list of sites to be loaded. Any other string (a name such as
+    # 'Mathematics' or a URL) is always resolved with the list of sites, which
+    # is loaded if the current SiteRegistry has not loaded it yet.
     def __init__(self, data, ignored=None):
         if isinstance(data, str):
-            self._domain = data
-            self._data = None
+            SiteRegistry.prepare()
+            is_parameter = data == data.lower() and not ' ' in data and not '/' in data
+            site = SiteRegistry.current.lookup(data, load=not is_parameter, names=not is_parameter)
+            self._domain = data if site is None else site['api_site_parameter']
+            self._data = None if site is None else Item(site, 'site')
         else:
             self._domain = data['api_site_parameter']
-            self._data = data
+            self._data = Item(data, 'site')
     
     ## Returns a Request object initialized to the specified method.
     # @param method the name of the method
@@ -52,7 +68,7 @@ class Site:
     # @return the specified attribute
     #
     # Note: if the information has not been previously retrieved (such as by the
-    # /sites method), this method will make the request to retrieve it.
+    # /sites method), the list of sites is loaded by the current SiteRegistry.
     def __getitem__(self, index):
         return getattr(self._fetch(), index)
     
@@ -67,11 +83,96 @@ class Site:
     # Note: this method will fetch the information if it hasn't already been
     # retrieved.
     def __str__(self):
-        return self._fetch()['name']
+        return self._fetch().name
     
     ## Either fetches the information for a site or returns it.
     # @returns the site's information
+    #
+    # Sites that are missing from the list of sites (such as those that were
+    # only just launched) are requested individually.
     def _fetch(self):
         if self._data is None:
-            self._data = self.info.filter('!*qYPS3vhc(3')[0].site
-        return self._data
\ No newline at end of file
+            SiteRegistry.prepare()
+            site = SiteRegistry.current.lookup(self._domain)
+            if site is None:
+                self._data = self.info.filter('!*qYPS3vhc(3')[0].site
+            else:
+                self._data = Item(site, 'site')
+        return self._data
+
+## Provides the information about every Stack Exchange site.
+#
+# Rather than requesting the information for each site individually, the
+# registry retrieves the complete list of sites from the /sites method once
+# and indexes it by API site parameter, name and URL (including any aliases).
+# The pages of the list are stored in the current database with a long TTL,
+# so that other processes using the same database do not need to request them.
+class SiteRegistry:
+    
+    ## The current registry that is being used.
+    current = None
+    
+    ## Determines if a registry is initialized and initializes one otherwise.
+    @staticmethod
+    def prepare():
+        if SiteRegistry.current is None:
+            SiteRegistry.current = SiteRegistry()
+    
+    ## Constructs a registry.
+    # @param ttl the Time-To-Live (TTL) for the list of sites (one week by default)
+    def __init__(self, ttl=7 * 24 * 60 * 60):
+        self._ttl   = ttl
+        self._sites = None # list of the data for each site once loaded
+        self._index = {}   # parameter or URL -> data
+        self._names = {}   # name -> data
+        self._lock  = Lock()
+    
+    ## Finds the information for a site.
+    # @param key the API site parameter, domain name, name or URL of the site
+    # @param load whether to load the list of sites if it has not been loaded
+    # @param names whether the key may also be the name of the site
+    # @return the data returned for the site by the /sites method or None if the site was not found
+    def lookup(self, key, load=True, names=True):
+        if self._sites is None:
+            if not load:
+                return None
+            self.load()
+        key = _normalize(key)
+        return self._index.get(key, self._names.get(key) if names else None)
+    
+    ## Returns every site.
+    # @return a list of Site objects
+    def sites(self):
+        if self._sites is None:
+            self.load()
+        return [Site(data) for data in self._sites]
+    
+    ## Loads the list of sites, following pagination.
+    #
+    # Note: this method does nothing if the list was already loaded.
+    def load(self):
+        with self._lock:
+            if not self._sites is None:
+                return
+            sites = []
+            for data in Request(URL().set_ttl(self._ttl), 'sites').iter_pages(100):
+                sites.extend(data['items'].raw)
+            (index, names) = ({}, {})
+            for site in sites:
+                keys = [site.get('api_site_parameter'), site.get('site_url'),] + site.get('aliases', [])
+                for key in keys:
+                    if key:
+                        index.setdefault(_normalize(key), site)
+                if site.get('name'):
+                    names.setdefault(_normalize(site['name']), site)
+            (self._sites, self._index, self._names) = (sites, index, names)
+
+## Normalizes a key for looking up a site.
+# @param key an API site parameter, domain name, name or URL
+# @return the key in lowercase without the scheme or trailing slash
+def _normalize(key):
+    key = key.strip().lower()
+    for scheme in ('http://', 'https://',):
+        if key.startswith(scheme):
+            key = key[len(scheme):]
+    return key.rstrip('/')
\ No newline at end of file
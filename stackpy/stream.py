@@ -0,0 +1,153 @@
+from codecs import getincrementaldecoder
+from json import JSONDecodeError, JSONDecoder
+from zlib import decompressobj, MAX_WBITS
+
+_decoder = JSONDecoder()
+
+## Incrementally parses a JSON response while it is being received.
+#
+# The parser is fed the text of the response piece by piece. It returns each
+# element of the top-level 'items' array as soon as the element is complete
+# and collects all other members of the response in ResponseParser.envelope.
+# Consumed text is discarded, so only the incomplete remainder of the response
+# is ever kept in memory.
+class ResponseParser:
+    
+    # The states of the parser
+    _START, _MEMBERS, _ITEMS, _END = range(4)
+    
+    ## Constructs the parser.
+    def __init__(self):
+        ## The members of the response other than 'items'.
+        self.envelope = {}
+        self._buffer  = ''
+        self._pos     = 0
+        self._state   = self._START
+    
+    ## Parses the next piece of the response.
+    # @param text the next piece of the response
+    # @return a list of the items that were completed by the text
+    def feed(self, text):
+        # Discard consumed text once enough of it has accumulated
+        if self._pos > 65536:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        self._buffer += text
+        items = []
+        while self._step(items, False):
+            pass
+        return items
+    
+    ## Parses the remainder of the response once all of it has been received.
+    # @return a list of the items that were completed
+    def close(self):
+        items = []
+        while self._step(items, True):
+            pass
+        if self._state != self._END:
+            raise ValueError('incomplete JSON response')
+        return items
+    
+    ## Skips whitespace and returns the next character.
+    # @return the next character or None if the buffer is exhausted
+    def _peek(self):
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\r\n':
+            self._pos += 1
+        return self._buffer[self._pos] if self._pos < len(self._buffer) else None
+    
+    ## Decodes the JSON value at the current position.
+    # @param final whether the buffer contains the remainder of the response
+    # @return a tuple containing the value and the position after it, or None if the value is incomplete
+    #
+    # Unless the response is complete, a value must be followed by a delimiter
+    # since a number that is cut off (such as '15' from '1500.0') is otherwise
+    # indistinguishable from a complete one.
+    def _value(self, final):
+        self._peek()
+        try:
+            (value, end) = _decoder.raw_decode(self._buffer, self._pos)
+        except JSONDecodeError:
+            if final:
+                raise
+            return None
+        if not final and (end == len(self._buffer) or not self._buffer[end] in ',:]} \t\r\n'):
+            return None
+        return (value, end,)
+    
+    ## Parses as much of the buffer as possible in the current state.
+    # @param items the list to append completed items to
+    # @param final whether the buffer contains the remainder of the response
+    # @return True if progress was made
+    def _step(self, items, final):
+        c = self._peek()
+        if c is None:
+            return False
+        if self._state == self._START:
+            if c != '{':
+                raise ValueError('JSON response is not an object')
+            self._pos += 1
+            self._state = self._MEMBERS
+            return True
+        if self._state == self._MEMBERS:
+            if c == ',':
+                self._pos += 1
+                return True
+            if c == '}':
+                self._pos += 1
+                self._state = self._END
+                return True
+            # Decode the member's name and locate its value
+            start = self._pos
+            name = self._value(final)
+            if name is None:
+                return False
+            self._pos = name[1]
+            if self._peek() != ':':
+                self._pos = start
+                if final:
+                    raise ValueError('malformed JSON response')
+                return False
+            self._pos += 1
+            if name[0] == 'items':
+                if self._peek() != '[':
+                    self._pos = start
+                    if final:
+                        raise ValueError('malformed JSON response')
+                    return False
+                self._pos += 1
+                self._state = self._ITEMS
+                return True
+            value = self._value(final)
+            if value is None:
+                self._pos = start
+                return False
+            self.envelope[name[0]] = value[0]
+            self._pos = value[1]
+            return True
+        if self._state == self._ITEMS:
+            if c == ',':
+                self._pos += 1
+                return True
+            if c == ']':
+                self._pos += 1
+                self._state = self._MEMBERS
+                return True
+            value = self._value(final)
+            if value is None:
+                return False
+            items.append(value[0])
+            self._pos = value[1]
+            return True
+        raise ValueError('unexpected data after JSON response')
+
+## Decodes the items of a GZipped JSON response while it is being received.
+# @param chunks an iterable of pieces of the GZipped response
+# @param parser the ResponseParser to use (its envelope is complete once the generator is exhausted)
+# @return a generator yielding each item
+def iter_items(chunks, parser):
+    decompressor = decompressobj(16 + MAX_WBITS)
+    decoder = getincrementaldecoder('UTF-8')()
+    for chunk in chunks:
+        yield from parser.feed(decoder.decode(decompressor.decompress(chunk)))
+    yield from parser.feed(decoder.decode(decompressor.flush(), True))
+    yield from parser.close()
@@ -0,0 +1,174 @@
+from json import dumps
+from sqlite3 import connect
+from threading import Lock
+
+from .database import Database
+from .item import Item
+from .request import Request
+from .types import METHOD_TO_TYPE_MAPPING, TYPE_INFORMATION
+
+MARK_TABLE_SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS marks (
+    request blob NOT NULL,
+    field varchar(255) NOT NULL,
+    value int(11) NOT NULL,
+    PRIMARY KEY (request, field)
+  );
+'''
+
+## The parameters that are controlled by Mirror.sync or by pagination and therefore do not identify a request.
+SYNC_PARAMETERS = ['max', 'min', 'order', 'page', 'pagesize', 'sort',]
+
+## The fields that can be used as high-water marks and the sort order that corresponds with each.
+SYNC_FIELDS = {'creation_date':      'creation',
+               'last_activity_date': 'activity',
+               'last_modified_date': 'modified',}
+
+## Keeps a local copy of the items returned by requests up to date.
+#
+# Repeatedly downloading a complete set of items to find out which of them have
+# changed uses up the quota quickly. A Mirror instead records the highest value
+# of a date field (the high-water mark) that it has seen for each request -
+# requests are identified by their methods (including any IDs) and parameters
+# other than those in SYNC_PARAMETERS. Subsequent syncs sort the request by that
+# field and only ask for items at or past the mark using the 'min' parameter.
+#
+# The items are stored in a table for each type. In addition to the JSON of
+# each item, the table contains a column for the ID field and for each date
+# field listed in types.TYPE_INFORMATION, and the fields in SYNC_FIELDS are
+# indexed. Items are replaced when they are synced again.
+class Mirror:
+    
+    ## Opens (and creates if necessary) a mirror.
+    # @param database the filename of the SQLite database to use
+    # @param timeout the number of seconds to wait for another process to release a lock
+    def __init__(self, database, timeout=30):
+        self._connection = connect(database, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = Lock()
+        self._tables = set()
+        with self._lock:
+            self._connection.execute(MARK_TABLE_SCHEMA)
+    
+    ## Retrieves the items that changed since the last sync and stores them.
+    # @param request a Request for a site-specific method (such as site.questions)
+    # @param field the date field to use as the high-water mark (see SYNC_FIELDS)
+    # @param pagesize the number of items to request per page
+    # @return the number of items that were stored
+    #
+    # The request's own sort order and 'min' parameter are replaced. The first
+    # sync of a request retrieves every item.
+    def sync(self, request, field='last_activity_date', pagesize=100):
+        if not field in SYNC_FIELDS:
+            raise ValueError('"%s" cannot be used as a high-water mark.' % field)
+        (site, method) = (request._url.parameter('site'), request._url.base_method(),)
+        if site is None:
+            raise ValueError('Only requests for site-specific methods can be mirrored.')
+        item_type = METHOD_TO_TYPE_MAPPING.get(method)
+        if not field in TYPE_INFORMATION.get(item_type, {}).get('date_fields', []):
+            raise ValueError('The items returned by "%s" do not contain "%s".' % (method, field,))
+        table = self._table(item_type)
+        key = request._url.cache_key(SYNC_PARAMETERS)
+        mark = self._mark(key, field)
+        # Syncs must never be answered from the cache
+        url = request._url.set_ttl(0).add_parameter('sort', SYNC_FIELDS[field]).add_parameter('order', 'asc')
+        if not mark is None:
+            # The mark is included since other items may share its timestamp
+            url = url.add_parameter('min', mark)
+        count = 0
+        for data in Request(url).iter_pages(pagesize):
+            items = data['items'].raw
+            values = [i[field] for i in items if field in i]
+            if values:
+                mark = max(values + ([] if mark is None else [mark,]))
+            self._store(table, site, item_type, items, (key, field, mark,))
+            count += len(items)
+        return count
+    
+    ## Returns the high-water mark for a request.
+    # @param request a Request that was passed to Mirror.sync
+    # @param field the date field used as the mark
+    # @return the timestamp or None if the request has not been synced
+    def mark(self, request, field='last_activity_date'):
+        return self._mark(request._url.cache_key(SYNC_PARAMETERS), field)
+    
+    ## Returns the high-water mark stored for a request key.
+    # @param key the key identifying the request
+    # @param field the date field used as the mark
+    # @return the timestamp or None if the request has not been synced
+    def _mark(self, key, field):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM marks WHERE request = ? AND field = ?',
+                                           [key, field,]).fetchone()
+        return None if row is None else row[0]
+    
+    ## Returns the items of a type stored in the mirror.
+    # @param item_type the type of the items
+    # @param site the API site parameter to return the items for or None for all sites
+    # @param since a timestamp - only items with a last_activity_date (or creation_date) at or after it are returned
+    # @return a list of Item objects
+    def items(self, item_type, site=None, since=None):
+        table = self._table(item_type)
+        (conditions, parameters) = ([], [])
+        if not site is None:
+            conditions.append('site = ?')
+            parameters.append(site)
+        if not since is None:
+            date_fields = TYPE_INFORMATION[item_type].get('date_fields', [])
+            conditions.append('%s >= ?' % ('last_activity_date' if 'last_activity_date' in date_fields else 'creation_date'))
+            parameters.append(since)
+        query = 'SELECT data FROM %s%s' % (table, ' WHERE ' + ' AND '.join(conditions) if conditions else '',)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [Item(Database.decoder(row[0]), item_type) for row in rows]
+    
+    ## Returns the columns of the table for a type.
+    # @param item_type the type of the items
+    # @return a list of the names of the columns (excluding site and data)
+    def _columns(self, item_type):
+        type_info = TYPE_INFORMATION[item_type]
+        return [type_info['id_field'],] + [f for f in type_info.get('date_fields', []) if f != type_info['id_field']]
+    
+    ## Creates the table for a type if it does not exist yet.
+    # @param item_type the type of the items
+    # @return the name of the table
+    def _table(self, item_type):
+        if not 'id_field' in TYPE_INFORMATION.get(item_type, {}):
+            raise ValueError('Items of type "%s" cannot be mirrored.' % item_type)
+        table = 'mirror_%s' % item_type
+        if not table in self._tables:
+            columns = self._columns(item_type)
+            id_field = columns[0]
+            definitions = ['site varchar(255) NOT NULL', '%s varchar(255) NOT NULL' % id_field,]
+            definitions.extend('%s int(11)' % f for f in columns[1:])
+            definitions.extend(['data text NOT NULL', 'PRIMARY KEY (site, %s)' % id_field,])
+            with self._lock:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS %s (%s);' % (table, ', '.join(definitions),))
+                for f in columns[1:]:
+                    if f in SYNC_FIELDS:
+                        self._connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s);' % (table, f, table, f,))
+            self._tables.add(table)
+        return table
+    
+    ## Stores items in the table for their type along with the new high-water mark.
+    # @param table the name of the table
+    # @param site the API site parameter
+    # @param item_type the type of the items
+    # @param items a list of dictionaries
+    # @param mark a tuple containing the request key, field and value of the mark
+    #
+    # Both are written in a single transaction, so the mark never moves past
+    # items that were not stored.
+    def _store(self, table, site, item_type, items, mark):
+        columns = self._columns(item_type)
+        rows = [[site,] + [i.get(c) for c in columns] + [dumps(i),] for i in items if columns[0] in i]
+        query = 'INSERT OR REPLACE INTO %s (site, %s, data) VALUES (%s)' % (table, ', '.join(columns), ','.join('?' * (len(columns) + 2)),)
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.executemany(query, rows)
+                if not mark[2] is None:
+                    self._connection.execute('INSERT OR REPLACE INTO marks (request, field, value) VALUES (?,?,?)', mark)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
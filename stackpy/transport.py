@@ -0,0 +1,208 @@
+from asyncio import TimeoutError as AsyncTimeoutError, open_connection, wait_for
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection
+from os import getpid
+from ssl import create_default_context
+from threading import Lock
+from time import time
+from urllib.parse import urlsplit
+from zlib import decompress, MAX_WBITS
+
+## Provides persistent (keep-alive) HTTP connections to the API servers.
+#
+# Establishing a connection (and especially performing a TLS handshake) is
+# frequently more expensive than the request itself. A ConnectionPool keeps
+# idle connections open for each scheme and host so that subsequent requests
+# can reuse them. The pool may be shared between threads. Processes forked from
+# the one that created the pool never reuse the connections it inherited, since
+# the parent may still be using the same sockets.
+class ConnectionPool:
+    
+    ## The current pool that is being used.
+    current = None
+    
+    ## Determines if a pool is initialized and initializes one otherwise.
+    @staticmethod
+    def prepare():
+        if ConnectionPool.current is None:
+            ConnectionPool.current = ConnectionPool()
+    
+    ## Constructs a connection pool.
+    # @param size the maximum number of idle connections kept for each scheme and host
+    # @param idle_timeout the number of seconds after which an idle connection is discarded
+    # @param timeout the socket timeout in seconds used for each connection (and the time limit for asynchronous requests)
+    def __init__(self, size=8, idle_timeout=30, timeout=30):
+        self.timeout       = timeout
+        self._size         = size
+        self._idle_timeout = idle_timeout
+        self._idle         = {} # (scheme, host) -> [(connection, time returned to the pool), ...]
+        self._lock         = Lock()
+        self._pid          = getpid() # the process the idle connections belong to
+    
+    ## Performs an HTTP request using a pooled connection.
+    # @param url the complete URL to request
+    # @param data an optional bytes object to send as the body of a POST request
+    # @param decode whether to decompress the body according to its Content-Encoding header
+    # @return a tuple containing the status code and the body of the response
+    #
+    # Since the pool always accepts GZipped responses, the body is returned as
+    # received (and is therefore usually compressed) unless decode is set.
+    #
+    # If a reused connection turns out to have been closed by the server, the
+    # request is transparently retried on a new connection.
+    def request(self, url, data=None, decode=False):
+        with self.open(url, data) as response:
+            body = response.read()
+            if decode and (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+                body = decompress(body, 16 + MAX_WBITS)
+            return (response.status, body,)
+    
+    ## Performs an HTTP request and provides the response while it is received.
+    # @param url the complete URL to request
+    # @param data an optional bytes object to send as the body of a POST request
+    # @return a context manager providing the http.client.HTTPResponse
+    #
+    # The body can be read piece by piece using read(amt). The connection is
+    # only returned to the pool if the body was read completely, otherwise it is
+    # closed when the context is left.
+    @contextmanager
+    def open(self, url, data=None):
+        parts   = urlsplit(url)
+        key     = (parts.scheme, parts.netloc,)
+        path    = parts.path + ('?' + parts.query if parts.query else '')
+        headers = {'Accept-Encoding': 'gzip',}
+        if not data is None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        while True:
+            (connection, reused) = self._acquire(key)
+            try:
+                connection.request('GET' if data is None else 'POST', path, data, headers)
+                response = connection.getresponse()
+                break
+            except ConnectionError:
+                connection.close()
+                # Only connections that sat idle in the pool are retried
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            self._release(key, connection)
+        else:
+            connection.close()
+    
+    ## Closes all idle connections.
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for (connection, returned) in connections:
+                connection.close()
+    
+    ## Retrieves an idle connection or creates a new one.
+    # @param key the scheme and host of the connection
+    # @return a tuple containing the connection and whether it was reused
+    def _acquire(self, key):
+        if self._pid != getpid():
+            # The sockets are shared with the parent, so they are abandoned without being closed
+            (self._idle, self._lock, self._pid) = ({}, Lock(), getpid(),)
+        expired = []
+        connection = None
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                (candidate, returned) = connections.pop()
+                if time() - returned < self._idle_timeout:
+                    connection = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if not connection is None:
+            return (connection, True,)
+        (scheme, host) = key
+        connection_type = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return (connection_type(host, timeout=self.timeout), False,)
+    
+    ## Returns a connection to the pool.
+    # @param key the scheme and host of the connection
+    # @param connection the connection to return
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self._size:
+                connections.append((connection, time(),))
+                return
+        connection.close()
+
+## Performs an HTTP request without blocking the event loop.
+# @param url the complete URL to request
+# @param data an optional bytes object to send as the body of a POST request
+# @param timeout the number of seconds after which the request is abandoned (None to wait indefinitely)
+# @return the body of the response
+#
+# This is the asynchronous counterpart of urlopen(url, data).read(). The body is
+# returned regardless of the status code because the API describes errors in
+# the body of the response. A TimeoutError (which, like the socket timeouts of
+# synchronous requests, is an OSError) is raised if the complete response has
+# not been received within the time limit.
+async def async_urlopen(url, data=None, timeout=30):
+    try:
+        return await wait_for(_async_urlopen(url, data), timeout)
+    except AsyncTimeoutError:
+        raise TimeoutError('timed out while requesting %s' % url) from None
+
+## Performs an HTTP request without a time limit.
+# @param url the complete URL to request
+# @param data an optional bytes object to send as the body of a POST request
+# @return the body of the response
+async def _async_urlopen(url, data):
+    parts  = urlsplit(url)
+    secure = parts.scheme == 'https'
+    path   = parts.path + ('?' + parts.query if parts.query else '')
+    (reader, writer) = await open_connection(parts.hostname,
+                                             parts.port or (443 if secure else 80),
+                                             ssl=create_default_context() if secure else None)
+    try:
+        headers = ['%s %s HTTP/1.1' % ('GET' if data is None else 'POST', path,),
+                   'Host: %s' % parts.netloc,
+                   'Accept-Encoding: gzip',
+                   'Connection: close',]
+        if not data is None:
+            headers.append('Content-Type: application/x-www-form-urlencoded')
+            headers.append('Content-Length: %d' % len(data))
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('ascii'))
+        if not data is None:
+            writer.write(data)
+        await writer.drain()
+        # Skip the status line and collect the headers
+        await reader.readline()
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            (name, value) = line.split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+        # Read the body using whichever framing the server chose
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            return b''.join(chunks)
+        if 'content-length' in response_headers:
+            return await reader.readexactly(int(response_headers['content-length']))
+        return await reader.read()
+    finally:
+        writer.close()
@@ -101,6 +101,18 @@ METHOD_TO_TYPE_MAPPING = {
     'users/moderators/elected':        'user',
 }
 
+## Contains the request paths that return exactly the objects whose IDs are supplied.
+#
+# Responses to these methods can be assembled from individually cached objects
+# (see URL.retrieve_entities).
+ENTITY_METHODS = ['answers/*',
+                  'badges/*',
+                  'comments/*',
+                  'posts/*',
+                  'questions/*',
+                  'suggested-edits/*',
+                  'users/*',]
+
 ## Returns the string representation of an inbox item.
 # @param item a dictionary containing the inbox item
 # @return the string representation of the item
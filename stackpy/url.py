@@ -1,11 +1,19 @@
-from json import loads
+from asyncio import get_running_loop, sleep
+from itertools import product
+from json import dumps
+from threading import Event, Lock, Thread
+from time import perf_counter, time
 from urllib.parse import urlencode
-from urllib.request import urlopen
-from urllib.error import HTTPError
-from zlib import decompress, MAX_WBITS
+from zlib import decompress, error, MAX_WBITS
 
-from .database import Database
+from . import api
+from .database import Database, cache_key
 from .filter import Filter
+from .metrics import Metrics
+from .scheduler import Scheduler
+from .stream import ResponseParser, iter_items
+from .transport import ConnectionPool, async_urlopen
+from .types import ENTITY_METHODS, METHOD_TO_TYPE_MAPPING, TYPE_INFORMATION
 
 ## Represents an error that occurred while accessing the API.
 class APIError(Exception):
@@ -25,28 +33,102 @@ class APIError(Exception):
     def error_id(self):
         return self._error_id
 
+## Tracks a request that is in progress so that identical requests can share its result.
+class _Flight:
+    
+    ## Constructs the flight.
+    def __init__(self):
+        self.done  = Event()
+        self.data  = None
+        self.error = None
+
+## The flights currently in progress, indexed by URL and POST data.
+_flights = {}
+_flights_lock = Lock()
+
+## Performs a request unless an identical one is already in progress.
+# @param key the URL and POST data of the request
+# @param download a function that performs the request and returns the decoded data
+# @return the decoded data
+#
+# Only the first caller for a key performs the request. Callers arriving while
+# it is in progress wait for it and receive a copy of its data or the same
+# exception.
+def _coalesce(key, download):
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if leader:
+        try:
+            flight.data = download()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with _flights_lock:
+                del _flights[key]
+            flight.done.set()
+    else:
+        flight.done.wait()
+        if not flight.error is None:
+            raise flight.error
+    # Request replaces the items when the data is wrapped, so each caller needs its own dictionary
+    return dict(flight.data)
+
 ## Represents a %URL for accessing an API resource.
 #
 # The URL class provides methods for manipulating a %URL that will eventually be
 # used to access an API method. There is rarely a need to interact with this
 # class directly - instead use the methods of API and Site.
+#
+# URLs are immutable. The methods that alter a URL return a new URL that shares
+# all unchanged members with the original, so that a URL can be branched into
+# many requests without copying it. The string form and cache key of each URL
+# are computed only once.
 class URL:
     
+    ## Default grace period (in seconds) for all URLs.
+    #
+    # See URL.set_grace for details. You can change this value at any time and
+    # it will affect any URLs that are created after setting this attribute.
+    default_grace = 0
+    
+    # Members (including the parameter dictionary) are shared between URLs and
+    # must therefore never be modified in place
+    __slots__ = ('_prefix', '_method', '_methods', '_base_methods', '_vectors', '_parameters',
+                 '_ttl', '_grace', '_error_grace', '_str', '_key',)
+    
     ## Constructs a URL object optionally initialized to a domain.
     # @param domain a site domain name
     def __init__(self, domain=None):
         self._prefix       = 'http'
         self._method       = 'GET'
-        self._methods      = []
-        self._base_methods = []
-        self._parameters   = {}
+        self._methods      = ()
+        self._base_methods = ()
+        self._vectors      = {} # index in _methods -> tuple of IDs
         # Add two default parameters to accompany each request
-        from . import api
-        self._parameters['key']    = api.API.key
-        self._parameters['filter'] = Filter.default
+        self._parameters   = {'key':    api.API.key,
+                              'filter': Filter.default,}
         if not domain is None:
             self._parameters['site'] = domain
         self._ttl = 600 # cache data for 10 minutes by default
+        self._grace       = URL.default_grace
+        self._error_grace = URL.default_grace
+        self._str = None
+        self._key = None
+    
+    ## Returns a new URL that differs from this one in the specified members.
+    # @param changes the names of the members (without the leading underscore) and their new values
+    # @return the new URL
+    def _derive(self, **changes):
+        url = URL.__new__(URL)
+        for name in URL.__slots__:
+            setattr(url, name, changes.get(name[1:], getattr(self, name)))
+        url._str = None
+        url._key = None
+        return url
     
     ## Returns an internal representation of the URL.
     # @return the internal representation
@@ -57,9 +139,11 @@ class URL:
     ## Constructs the string representation of the URL.
     # @return the complete URL as a string
     def __str__(self):
-        return '%s://api.stackexchange.com/2.1/%s%s' % (self._prefix,
-                                                        '/'.join(self._methods),
-                                                        '?' + urlencode(self._parameters) if self._method == 'GET' else '',)
+        if self._str is None:
+            self._str = '%s://api.stackexchange.com/2.1/%s%s' % (self._prefix,
+                                                                 '/'.join(self._methods),
+                                                                 '?' + urlencode(self._parameters) if self._method == 'GET' else '',)
+        return self._str
     
     ## Retrieves the JSON data for the provided URL.
     # @param forbid_empty raises an error if fewer than one item is returned
@@ -69,20 +153,244 @@ class URL:
     # JSON for that URL or return the latest value from the cache.
     def fetch(self, forbid_empty=False):
         url = str(self)
-        # If caching is enabled for this URL, check the cache
+        post_data = self._post_data()
+        (entry, data) = self._lookup(url, post_data)
+        if data is None:
+            try:
+                data = _coalesce((url, post_data,), lambda: self._download(url, post_data))
+            except (APIError, OSError, error):
+                if not self._usable_on_error(entry):
+                    raise
+                data = entry[0]
+        return self._check(data, forbid_empty)
+    
+    ## Retrieves the JSON data for the provided URL without blocking.
+    # @param forbid_empty raises an error if fewer than one item is returned
+    # @returns the JSON response
+    #
+    # This is the coroutine equivalent of URL.fetch and must be awaited. The
+    # database is accessed on the event loop's default executor so that the
+    # loop is not blocked while SQLite waits for the disk or a lock.
+    async def afetch(self, forbid_empty=False):
+        loop = get_running_loop()
+        url = str(self)
+        post_data = self._post_data()
+        (entry, data) = await loop.run_in_executor(None, self._lookup, url, post_data)
+        if data is None:
+            try:
+                Scheduler.prepare()
+                ConnectionPool.prepare()
+                delay = Scheduler.current.reserve(self.base_method())
+                if delay > 0:
+                    await sleep(delay)
+                start = perf_counter()
+                raw_data = await async_urlopen(url, post_data, ConnectionPool.current.timeout)
+                self._record_http(perf_counter() - start, len(raw_data))
+                data = await loop.run_in_executor(None, self._process, raw_data)
+            except (APIError, OSError, error):
+                if not self._usable_on_error(entry):
+                    raise
+                data = entry[0]
+        return self._check(data, forbid_empty)
+    
+    ## Retrieves the items for the URL while the response is being received.
+    # @param envelope a dictionary that receives the members of the response other than 'items'
+    # @return a generator yielding each raw item
+    #
+    # Unlike URL.fetch, the response is decoded incrementally so that the first
+    # items are available before the remainder of the response has arrived and
+    # the decoded response is never held in memory at once. The envelope is
+    # complete once the generator is exhausted. The compressed response is
+    # added to the database cache but neither to the memory cache nor to the
+    # entity cache since both would require the complete decoded response.
+    def stream(self, envelope):
+        url = str(self)
+        post_data = self._post_data()
+        data = self._lookup(url, post_data)[1]
+        if not data is None:
+            envelope.update((k, v) for (k, v) in data.items() if k != 'items')
+            yield from data['items']
+            return
+        Scheduler.prepare()
+        Scheduler.current.wait(self.base_method())
+        ConnectionPool.prepare()
+        parser = ResponseParser()
+        chunks = []
+        size = 0
+        with ConnectionPool.current.open(url, post_data) as response:
+            def read():
+                nonlocal size
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self._ttl:
+                        chunks.append(chunk)
+                    yield chunk
+            yield from iter_items(read(), parser)
+        metrics = Metrics.current
+        if not metrics is None:
+            # The transfer overlaps with decoding and with the consumer, so only its size is recorded
+            metrics.record(self.base_method(), 'bytes', size)
+            if 'quota_remaining' in parser.envelope:
+                metrics.record(self.base_method(), 'quota', 1)
+        envelope.update(parser.envelope)
+        Scheduler.current.update(self.base_method(), envelope)
+        if 'error_id' in envelope and 'error_message' in envelope:
+            raise APIError(envelope['error_id'], envelope['error_message'])
+        if self._ttl:
+            Database.current.add_to_cache(self.cache_key(), b''.join(chunks), self._ttl)
+    
+    ## Retrieves and decodes the response for the URL from the API server.
+    # @param url the complete URL
+    # @param post_data the body of the request or None
+    # @return the decoded data
+    def _download(self, url, post_data):
+        Scheduler.prepare()
+        Scheduler.current.wait(self.base_method())
+        # The body is used regardless of the status code because it contains any error messages
+        ConnectionPool.prepare()
+        start = perf_counter()
+        (status, raw_data) = ConnectionPool.current.request(url, post_data)
+        self._record_http(perf_counter() - start, len(raw_data))
+        return self._process(raw_data)
+    
+    ## Records the time taken by a request and the size of its response with the current Metrics.
+    # @param duration the number of seconds taken to send the request and receive the response
+    # @param size the size of the compressed response
+    def _record_http(self, duration, size):
+        metrics = Metrics.current
+        if not metrics is None:
+            metrics.record(self.base_method(), 'http', duration)
+            metrics.record(self.base_method(), 'bytes', size)
+    
+    ## Looks up the data for the URL in the cache.
+    # @param url the complete URL
+    # @param post_data the body of the request or None
+    # @return a tuple containing the cached entry (see URL._retrieve_from_cache) and the data to return or None
+    #
+    # The duration of the lookup and whether it succeeded are recorded with the
+    # current Metrics.
+    def _lookup(self, url, post_data):
+        metrics = Metrics.current
+        start = perf_counter()
+        entry = self._retrieve_from_cache()
+        data = self._use_cached(url, post_data, entry)
+        if not metrics is None and self._ttl:
+            metrics.record(self.base_method(), 'cache_lookup', perf_counter() - start)
+            metrics.record(self.base_method(), 'cache_miss' if data is None else 'cache_hit', 1)
+        return (entry, data,)
+    
+    ## Returns the cached data for the URL if caching is enabled and the data is available.
+    # @return a tuple containing the data and the time at which it expires or None if unavailable
+    #
+    # Expired data is also returned if it is still within either of the URL's
+    # grace periods.
+    def _retrieve_from_cache(self):
         if self._ttl:
             Database.prepare()
-            json_data = Database.current.retrieve_from_cache(url)
-            if not json_data is None:
-                return loads(json_data)
-        # Catch any HTTP errors because we want to grab error messages
-        try:
-            post_data = urlencode(self._parameters) if self._method == 'POST' else None
-            raw_data = urlopen(url, data=post_data).read()
-        except HTTPError as e:
-            raw_data = e.read()
-        json_data = decompress(raw_data, 16 + MAX_WBITS).decode('UTF-8')
-        data = loads(json_data)
+            key = self.cache_key()
+            grace = max(self._grace, self._error_grace)
+            entry = Database.memory.retrieve_from_cache(key, True, grace)
+            if entry is None:
+                entry = Database.current.retrieve_from_cache(key, True, grace)
+                if entry is None:
+                    return None
+                (json_data, expires) = entry
+                entry = (Database.decoder(json_data), expires,)
+                Database.memory.add_to_cache(key, entry[0], len(json_data), expires)
+            # Request replaces the items when the data is wrapped, so the cached dictionary must not be returned
+            return (dict(entry[0]), entry[1],)
+        return None
+    
+    ## Determines whether cached data can be returned without contacting the API server.
+    # @param url the complete URL
+    # @param post_data the body of the request or None
+    # @param entry the cached data and expiry time or None
+    # @return the data or None if the API server must be contacted
+    #
+    # Data that expired within the grace period is returned while a background
+    # thread retrieves a fresh copy for subsequent requests.
+    def _use_cached(self, url, post_data, entry):
+        if entry is None:
+            return None
+        (data, expires) = entry
+        now = time()
+        if expires >= now:
+            return data
+        if expires + self._grace >= now:
+            self._revalidate(url, post_data)
+            return data
+        return None
+    
+    ## Determines whether cached data may be returned in place of a failed request.
+    # @param entry the cached data and expiry time or None
+    # @return True if the data may be returned
+    def _usable_on_error(self, entry):
+        return not entry is None and entry[1] + self._error_grace >= time()
+    
+    ## Retrieves a fresh copy of the data for the URL in the background.
+    # @param url the complete URL
+    # @param post_data the body of the request or None
+    def _revalidate(self, url, post_data):
+        key = (url, post_data,)
+        # There is no need for another thread if a request is already under way
+        if key in _flights:
+            return
+        def revalidate():
+            try:
+                _coalesce(key, lambda: self._download(url, post_data))
+            except (APIError, OSError, error):
+                pass # the stale data remains in the cache until the grace period ends
+        Thread(target=revalidate, daemon=True).start()
+    
+    ## Returns the scope of the objects in the response for the entity cache.
+    # @return a tuple containing the site, type and filter or None if the objects cannot be cached individually
+    #
+    # The objects returned by any request (such as /questions or /search) are
+    # cached individually if their type has an ID field, so that later requests
+    # for specific objects by ID with the same filter can be served from the
+    # entity cache. Objects returned for authenticated requests may include
+    # private data and are therefore never cached individually.
+    def _entity_scope(self):
+        item_type = METHOD_TO_TYPE_MAPPING.get(self.base_method())
+        if not self._ttl or not item_type in TYPE_INFORMATION or not 'id_field' in TYPE_INFORMATION[item_type]:
+            return None
+        if 'access_token' in self._parameters or not 'site' in self._parameters:
+            return None
+        return (self._parameters['site'], item_type, self._parameters['filter'],)
+    
+    ## Stores each object in a response in the entity cache.
+    # @param data the decoded data
+    def _add_entities(self, data):
+        scope = self._entity_scope()
+        if not scope is None:
+            id_field = TYPE_INFORMATION[scope[1]]['id_field']
+            entities = [(str(i[id_field]), dumps(i),) for i in data['items'] if id_field in i]
+            if entities:
+                Database.current.add_entities(scope, entities, self._ttl)
+    
+    ## Returns the body of the request if it is a POST request.
+    # @return the encoded parameters or None for GET requests
+    def _post_data(self):
+        return urlencode(self._parameters).encode('UTF-8') if self._method == 'POST' else None
+    
+    ## Decodes a raw response from the server and adds it to the cache.
+    # @param raw_data the GZipped response
+    # @return the decoded data
+    def _process(self, raw_data):
+        start = perf_counter()
+        json_data = decompress(raw_data, 16 + MAX_WBITS)
+        decompressed = perf_counter()
+        data = Database.decoder(json_data)
+        metrics = Metrics.current
+        if not metrics is None:
+            metrics.record(self.base_method(), 'decompress', decompressed - start)
+            metrics.record(self.base_method(), 'parse', perf_counter() - decompressed)
+            if 'quota_remaining' in data:
+                metrics.record(self.base_method(), 'quota', 1)
+        Scheduler.current.update(self.base_method(), data)
         # Check the data for errors
         if 'error_id' in data and 'error_message' in data:
             raise APIError(data['error_id'], data['error_message'])
@@ -90,8 +398,17 @@ class URL:
             raise KeyError('"items" missing from server response.')
         # Add it to the cache for next time
         if self._ttl:
-            Database.current.add_to_cache(url, json_data, self._ttl)
-        # If the caller wants at least one item, make sure there is
+            key = self.cache_key()
+            Database.current.add_to_cache(key, raw_data, self._ttl)
+            Database.memory.add_to_cache(key, dict(data), len(json_data), int(time()) + self._ttl)
+            self._add_entities(data)
+        return data
+    
+    ## Ensures that the data contains at least one item if required.
+    # @param data the decoded data
+    # @param forbid_empty raises an error if fewer than one item is returned
+    # @return the data
+    def _check(self, data, forbid_empty):
         if forbid_empty and not len(data['items']):
             raise IndexError('"items" is empty but at least one item was expected.')
         return data
@@ -99,52 +416,165 @@ class URL:
     ## Adds a method to the end of the URL.
     # @param method the name of the method
     # @param is_variable whether this 'method' can vary between requests
+    # @return the new URL
     #
     # A bit of an explanation for this method seems in order. The `is_variable`
     # parameter indicates whether this particular part of the method is
     # constant or if it represents an ID or tag or some other variant.
     def add_method(self, method, is_variable=False):
-        self._methods.append(method)
-        self._base_methods.append('*' if is_variable else method)
-        return self
+        return self._derive(methods=self._methods + (method,),
+                            base_methods=self._base_methods + ('*' if is_variable else method,))
+    
+    ## Adds a vector of IDs to the end of the URL.
+    # @param ids a list of strings
+    # @return the new URL
+    #
+    # The IDs are joined with semicolons just like any other variable method,
+    # but they are also recorded so that the URL can later be split into
+    # smaller requests with URL.split.
+    def add_vector(self, ids):
+        ids = tuple(ids)
+        vectors = dict(self._vectors)
+        vectors[len(self._methods)] = ids
+        return self._derive(methods=self._methods + (';'.join(ids),),
+                            base_methods=self._base_methods + ('*',),
+                            vectors=vectors)
+    
+    ## Splits the URL into URLs that each contain a limited number of IDs.
+    # @param size the maximum number of IDs in each vector
+    # @return a list of URLs
+    #
+    # The API refuses requests with more than 100 IDs in a vector. If any vector
+    # in this URL exceeds the size, a URL is returned for each combination of
+    # chunks, in the order of the original IDs. Since each of these URLs is
+    # likely to return more items than the default page size, the page size is
+    # increased to the maximum unless it was specified. If no vector is too
+    # large, a list containing only this URL is returned.
+    def split(self, size=100):
+        chunked = {i: [v[j:j + size] for j in range(0, len(v), size)] for (i, v) in self._vectors.items()}
+        if all(len(c) == 1 for c in chunked.values()):
+            return [self,]
+        indices = sorted(chunked)
+        base = self if 'pagesize' in self._parameters else self.add_parameter('pagesize', 100)
+        return [base._replace_vectors(zip(indices, chunks)) for chunks in product(*(chunked[i] for i in indices))]
     
     ## Adds a query string parameter to the URL.
     # @param name the name of the parameter
     # @param value the value for the parameter
+    # @return the new URL
     #
     # Note: if a parameter with the same name already exists, it will be replaced. Also,
     # if name is set to 'access_token', then the URL will switch to HTTPS.
     def add_parameter(self, name, value):
-        self._parameters[name] = str(value)
-        if name == 'access_token':
-            self.secure()
-        return self
+        parameters = dict(self._parameters)
+        parameters[name] = str(value)
+        return self._derive(parameters=parameters,
+                            prefix='https' if name == 'access_token' else self._prefix)
+    
+    ## Returns the key used for storing the response in the cache.
+    # @param exclude a list of parameters to leave out of the key
+    # @return the cache key
+    #
+    # Requests that differ only in the order of their parameters or in their
+    # API key share the same cache key. See database.cache_key for details.
+    def cache_key(self, exclude=()):
+        if exclude:
+            return cache_key('/'.join(self._methods), {k: v for (k, v) in self._parameters.items() if not k in exclude})
+        if self._key is None:
+            self._key = cache_key('/'.join(self._methods), self._parameters)
+        return self._key
+    
+    ## Retrieves the objects for the IDs in the URL from the entity cache.
+    # @return a tuple containing the list of IDs and a dictionary of the cached objects indexed by ID
+    #
+    # Every response is also stored as individual objects indexed by site, type,
+    # filter and ID. Requests for specific objects by ID (see
+    # types.ENTITY_METHODS) can thus be served partially from the cache, even if
+    # the exact set of IDs was never requested. None is returned if the URL is
+    # not such a request or if it contains any parameters that might affect the
+    # selection or order of the objects.
+    def retrieve_entities(self):
+        scope = self._entity_scope()
+        ids = self.vector()
+        if scope is None or not self.base_method() in ENTITY_METHODS or ids is None:
+            return None
+        if set(self._parameters) - set(['key', 'filter', 'site',]):
+            return None
+        Database.prepare()
+        entities = Database.current.retrieve_entities(scope, ids)
+        return (ids, {id: Database.decoder(data) for (id, data) in entities.items()},)
+    
+    ## Returns the IDs in the final vector of the URL.
+    # @return a list of the IDs without duplicates or None if the URL does not end with a vector
+    def vector(self):
+        index = len(self._methods) - 1
+        return list(dict.fromkeys(self._vectors[index])) if index in self._vectors else None
+    
+    ## Returns a copy of the URL with different IDs in place of its final vector.
+    # @param ids a list of strings
+    # @return the new URL
+    def replace_vector(self, ids):
+        return self._replace_vectors([(len(self._methods) - 1, ids,)])
+    
+    ## Returns a copy of the URL with different IDs in place of some of its vectors.
+    # @param vectors an iterable of tuples containing the index of a vector and its new IDs
+    # @return the new URL
+    def _replace_vectors(self, vectors):
+        methods = list(self._methods)
+        replaced = dict(self._vectors)
+        for (index, ids) in vectors:
+            methods[index] = ';'.join(ids)
+            replaced[index] = tuple(ids)
+        return self._derive(methods=tuple(methods), vectors=replaced)
+    
+    ## Returns the value of a query string parameter.
+    # @param name the name of the parameter
+    # @param default the value to return if the parameter has not been set
+    # @return the value of the parameter
+    def parameter(self, name, default=None):
+        return self._parameters[name] if name in self._parameters else default
     
     ## Returns the base method used for the request.
     # @return the base method
     #
     # The return value of this method is used extensively in the meta type
-    # system Stack.PY employs as well as observing the rate limit.
+    # system Stack.PY employs as well as observing the rate limit (see Scheduler).
     def base_method(self):
         return '/'.join(self._base_methods)
     
     ## Enables the secure HTTP protocol (HTTPS) for the URL.
+    # @return the new URL
     def secure(self):
-        self._prefix = 'https'
-        return self
+        return self._derive(prefix='https')
+    
+    ## Enables serving expired data from the cache (stale-while-revalidate).
+    # @param grace the number of seconds after expiry during which cached data is returned immediately
+    # @param error_grace the number of seconds after expiry during which cached data is returned if the request fails (defaults to grace)
+    # @return the new URL
+    #
+    # While cached data is within the grace period, it is returned immediately
+    # and a fresh copy is retrieved in the background. If a request fails due to
+    # an API error (such as throttling) or a network error, cached data within
+    # the error grace period is returned instead of raising the error.
+    #
+    # Note: a grace period of 0 (the default) disables this behavior. The
+    # database must retain expired entries for the grace period, see
+    # SQLiteDatabase's grace parameter.
+    def set_grace(self, grace, error_grace=None):
+        return self._derive(grace=grace,
+                            error_grace=grace if error_grace is None else error_grace)
     
     ## Sets the Time-To-Live (TTL) for this request.
     # @param ttl the TTL value for the URL
+    # @return the new URL
     #
     # Note: passing a value of 0 for ttl will result in caching being disabled for the URL
     def set_ttl(self, ttl):
-        self._ttl = ttl
-        return self
+        return self._derive(ttl=ttl)
     
     ## Switches the URL to a POST request instead of a GET request.
+    # @return the new URL
     #
     # Note: this will disable caching
     def switch_to_post(self):
-        self._method = 'POST'
-        self._ttl = 0
-        return self
+        return self._derive(method='POST', ttl=0)